@@ -1,4 +1,6 @@
+import hashlib
 import os
+import time
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
 
@@ -13,6 +15,30 @@ load_dotenv(dotenv_path=dotenv_path)
 
 app = Flask(__name__)
 
+# Stockfish analysis takes seconds per game, so repeated identical requests
+# (same PGN, same side) are served from a small TTL cache instead of
+# re-running the engine. Keyed on a digest of the PGN to avoid keeping the
+# full game text around as a dict key.
+_PROMPT_CACHE_TTL_SECONDS = 10 * 60
+_PROMPT_CACHE_MAX_ENTRIES = 64
+_prompt_cache = {}  # (pgn_digest, player_color) -> (timestamp, prompt)
+
+def _cached_game_prompt(pgn_string, player_color_str):
+    """Returns the LLM prompt for (pgn, color), caching successful analyses."""
+    key = (hashlib.sha256(pgn_string.encode('utf-8')).hexdigest(), player_color_str)
+    cached = _prompt_cache.get(key)
+    if cached is not None and time.time() - cached[0] < _PROMPT_CACHE_TTL_SECONDS:
+        print("Serving analysis prompt from cache.")
+        return cached[1]
+
+    llm_prompt = analyze_game_and_generate_prompt(pgn_string, player_color_str)
+    if llm_prompt and not llm_prompt.startswith("Error:"):
+        if len(_prompt_cache) >= _PROMPT_CACHE_MAX_ENTRIES:
+            # Drop the oldest entry (dicts preserve insertion order)
+            _prompt_cache.pop(next(iter(_prompt_cache)))
+        _prompt_cache[key] = (time.time(), llm_prompt)
+    return llm_prompt
+
 @app.route('/analyze', methods=['POST'])
 def analyze_pgn():
     data = request.get_json()
@@ -31,7 +57,7 @@ def analyze_pgn():
 
     try:
         print(f"Analyzing PGN for {player_color_str}...")
-        llm_prompt = analyze_game_and_generate_prompt(pgn_string, player_color_str)
+        llm_prompt = _cached_game_prompt(pgn_string, player_color_str)
         
         if llm_prompt.startswith("Error:") or not llm_prompt:
              # analyze_game_and_generate_prompt might return error strings or empty if issues occur
@@ -54,5 +80,7 @@ def analyze_pgn():
         return jsonify({'error': f'An unexpected server error occurred: {str(e)}'}), 500
 
 if __name__ == '__main__':
-    # Note: debug=True is convenient for development but should be False in production
-    app.run(debug=True, port=5001) # Using port 5001 to avoid common conflicts
+    # Development server only. In production run a real WSGI server so
+    # concurrent /analyze calls aren't serialized behind one thread, e.g.:
+    #   gunicorn -w 4 -k gthread --threads 8 -b 0.0.0.0:5001 app:app
+    app.run(port=5001) # Using port 5001 to avoid common conflicts
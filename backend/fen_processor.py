@@ -1,126 +1,293 @@
 import json
+import re
 import chess
 import chess.pgn
 import multiprocessing
+import threading
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.feather as feather
 from tqdm import tqdm
 import io
 import os
 
-INPUT_JSON_FILE = "data/lichess_studies_2.json"
-OUTPUT_PROCESSED_FILE = "data/processed_study_fens.json"
-OUTPUT_CHAPTER_TEXTS_FILE = "data/study_chapter_contents.json"
+INPUT_STUDIES_FILE = "data/lichess_studies_2.jsonl"
+LEGACY_INPUT_JSON_FILE = "data/lichess_studies_2.json"
+OUTPUT_PROCESSED_FILE = "data/processed_study_fens.feather"
+OUTPUT_CHAPTER_TEXTS_FILE = "data/study_chapter_contents.jsonl"
 
 # Ensure python-chess and tqdm are installed: pip install python-chess tqdm
 
+# One-to-many translation table expanding empty-square digits to dot runs
+# ('3' -> '...'); str.translate does the whole scan in C instead of a
+# per-character Python loop. Same table as fen_retriever uses.
+_DIGIT_EXPAND_TABLE = str.maketrans({str(i): '.' * i for i in range(1, 9)})
+
 def convert_fen_to_dotted_pieces(full_fen_string):
     """Converts the piece placement part of a FEN string to use dots for empty squares."""
     if not full_fen_string:
         return ""
-    piece_placement = full_fen_string.split(' ')[0]
-    dotted_placement = ''
-    for char in piece_placement:
-        if char.isdigit():
-            dotted_placement += '.' * int(char)
+    return full_fen_string.split(' ', 1)[0].translate(_DIGIT_EXPAND_TABLE)
+
+# Template for board_to_dotted: eight rank segments of dots joined by '/'
+_EMPTY_DOTTED_BOARD = b'/'.join([b'.' * 8] * 8)
+_DOT = ord('.')
+
+def _dotted_index(square):
+    """Maps a python-chess square to its byte offset in the dotted string."""
+    rank, file = divmod(square, 8)
+    # Rank 8 comes first in FEN order; each rank segment is 9 bytes ('/' included)
+    return (7 - rank) * 9 + file
+
+def board_to_dotted_bytes(board):
+    """Builds the dotted piece-placement bytearray directly from the board's piece map."""
+    buf = bytearray(_EMPTY_DOTTED_BOARD)
+    for square, piece in board.piece_map().items():
+        buf[_dotted_index(square)] = ord(piece.symbol())
+    return buf
+
+def board_to_dotted(board):
+    """
+    Builds the dotted piece-placement string (same format as
+    convert_fen_to_dotted_pieces) directly from the board's piece map,
+    skipping the full FEN string round-trip.
+    """
+    return board_to_dotted_bytes(board).decode('ascii')
+
+def apply_move_to_dotted(dotted, board, move):
+    """
+    Updates the dotted-board bytearray in place for move, which must not yet
+    have been pushed on board — O(1) per ply instead of rescanning all 64
+    squares. Returns False for moves that need a full rebuild (castling,
+    anything malformed); the caller rebuilds from the board after pushing.
+    """
+    if not move:
+        return True  # Null move: piece placement is unchanged
+    if board.is_castling(move):
+        return False
+    piece = board.piece_at(move.from_square)
+    if piece is None:
+        return False
+
+    symbol = piece.symbol()
+    if move.promotion:
+        promo_symbol = chess.piece_symbol(move.promotion)
+        symbol = promo_symbol.upper() if piece.color == chess.WHITE else promo_symbol
+    if board.is_en_passant(move):
+        # The captured pawn sits on the to-file of the from-rank
+        captured_square = chess.square(chess.square_file(move.to_square),
+                                       chess.square_rank(move.from_square))
+        dotted[_dotted_index(captured_square)] = _DOT
+
+    dotted[_dotted_index(move.from_square)] = _DOT
+    dotted[_dotted_index(move.to_square)] = ord(symbol)
+    return True
+
+# Nearly every chapter starts from the standard position, so its dotted form
+# is a shared module constant: ply 0 then costs a few bitboard compares and a
+# buffer copy instead of a piece-map scan, and all chapters reference one str.
+_STARTING_DOTTED_STR = convert_fen_to_dotted_pieces(chess.STARTING_BOARD_FEN)
+_STARTING_DOTTED_BYTES = _STARTING_DOTTED_STR.encode('ascii')
+_STARTING_BOARD = chess.Board()
+
+def _is_starting_position(board):
+    """Cheap bitboard-level check for the standard starting position."""
+    return (board.occupied == _STARTING_BOARD.occupied
+            and board.occupied_co[chess.WHITE] == _STARTING_BOARD.occupied_co[chess.WHITE]
+            and board.pawns == _STARTING_BOARD.pawns
+            and board.knights == _STARTING_BOARD.knights
+            and board.bishops == _STARTING_BOARD.bishops
+            and board.rooks == _STARTING_BOARD.rooks
+            and board.queens == _STARTING_BOARD.queens
+            and board.kings == _STARTING_BOARD.kings)
+
+# Each chapter of a study PGN starts with its own header block
+_CHAPTER_SPLIT_RE = re.compile(r'\n(?=\[Event )')
+
+def split_pgn_into_chapters(pgn_string):
+    """
+    Splits a multi-chapter study PGN into one PGN string per chapter with a
+    cheap text split on header boundaries — no chess parsing involved.
+    """
+    if not pgn_string:
+        return []
+    return [chapter for chapter in _CHAPTER_SPLIT_RE.split(pgn_string) if chapter.strip()]
+
+class DottedFenVisitor(chess.pgn.BaseVisitor):
+    """
+    Streaming PGN visitor collecting per-ply dotted FENs and move-annotated
+    comments in one pass, without allocating the GameNode tree that
+    chess.pgn.read_game builds by default (we only ever walked the mainline
+    once anyway). Variations are skipped.
+    result(): (headers, fen_entries, comment_lines) with fen_entries a list
+    of (ply, dotted_fen) tuples.
+    """
+    def __init__(self):
+        self.headers = {}
+        self.fen_entries = []
+        self.comment_lines = []
+        self._dotted = None
+        self._dotted_valid = True
+        self._last_move_label = None
+
+    def visit_header(self, tagname, tagvalue):
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        # TODO: Include other lines.
+        return chess.pgn.SKIP
+
+    def visit_move(self, board, move):
+        # board is the position *before* the move
+        if board.turn == chess.WHITE:
+            self._last_move_label = f"{board.fullmove_number}. {board.san(move)}"
         else:
-            dotted_placement += char
-    return dotted_placement
+            self._last_move_label = f"{board.fullmove_number}... {board.san(move)}"
+        if self._dotted is not None:
+            self._dotted_valid = apply_move_to_dotted(self._dotted, board, move)
 
-def process_single_study_data(study_item):
+    def visit_board(self, board):
+        # Called for the starting position and after each mainline move
+        if self._dotted is None or not self._dotted_valid:
+            if _is_starting_position(board):
+                self._dotted = bytearray(_STARTING_DOTTED_BYTES)
+                self._dotted_valid = True
+                self.fen_entries.append((board.ply(), _STARTING_DOTTED_STR))
+                return
+            self._dotted = board_to_dotted_bytes(board)
+            self._dotted_valid = True
+        self.fen_entries.append((board.ply(), self._dotted.decode('ascii')))
+
+    def visit_comment(self, comment):
+        text = comment.strip()
+        if not text:
+            return
+        if self._last_move_label is None:
+            self.comment_lines.append(f"Initial Chapter Comment: {text}")
+        else:
+            self.comment_lines.append(f"{self._last_move_label}: {text}")
+
+    def handle_error(self, error):
+        # Mirror GameBuilder: log and skip the offending token so the rest of
+        # the chapter still gets processed.
+        print(f"Error during PGN parsing: {error}")
+
+    def result(self):
+        return (self.headers, self.fen_entries, self.comment_lines)
+
+_EMPTY_PLIES = np.empty(0, dtype=np.int32)
+
+def process_chapter_columns(chapter_task):
     """
-    Processes a single study item (dictionary) to extract FENs for each ply 
-    and chapter text content.
-    Returns a tuple: (list_of_fen_records, chapter_texts_map_for_this_study)
-    - list_of_fen_records: FENs without chapter text.
-    - chapter_texts_map_for_this_study: {chapter_identifier: chapter_text_content}
+    Processes one chapter's PGN text into columnar form. study_id and the
+    chapter identifier repeat for every ply of a chapter, so they are sent
+    back to the parent process once per chapter rather than once per record —
+    pickling a list of 5-field dicts across the pool costs more than the
+    parsing itself on large corpora.
+    chapter_task: (study_id, study_title, chapter_num, chapter_pgn)
+    Returns (study_id, chapter_identifier, dotted_fens, plies, chapter_text);
+    chapter_text is None when the chapter could not be parsed.
     """
+    study_id, study_title, chapter_num, chapter_pgn = chapter_task
+
+    chapter_identifier = f"{study_title} - Chapter {chapter_num}"
+    try:
+        visited = chess.pgn.read_game(io.StringIO(chapter_pgn), Visitor=DottedFenVisitor)
+        if visited is None:
+            return (study_id, chapter_identifier, [], _EMPTY_PLIES, None)
+        headers, fen_entries, comment_lines = visited
+
+        chapter_title_from_headers = headers.get("Event", f"Chapter {chapter_num}")
+        chapter_identifier = f"{study_title} - {chapter_title_from_headers}"
+
+        dotted_fens = [dotted_fen for _, dotted_fen in fen_entries]
+        plies = np.array([ply for ply, _ in fen_entries], dtype=np.int32)
+        chapter_text = "\n".join(comment_lines)
+    except Exception as e:
+        print(f"Error processing PGN for study {study_id} ('{study_title}'), chapter context: '{chapter_identifier}': {e}. Skipping this chapter.")
+        return (study_id, chapter_identifier, [], _EMPTY_PLIES, None)
+
+    return (study_id, chapter_identifier, dotted_fens, plies, chapter_text)
+
+def process_single_chapter(chapter_task):
+    """
+    Dict-record view over process_chapter_columns, for callers that want
+    individual FEN records rather than columns.
+    Returns a tuple: (list_of_fen_records, {chapter_identifier: chapter_text_content})
+    """
+    study_id, chapter_identifier, dotted_fens, plies, chapter_text = process_chapter_columns(chapter_task)
+    if chapter_text is None:
+        return ([], {})
+    processed_fens_for_chapter = [{
+        "dotted_fen": dotted_fen,
+        "study_id": study_id,
+        "chapter": chapter_identifier,
+        "ply": int(ply)
+    } for dotted_fen, ply in zip(dotted_fens, plies)]
+    return (processed_fens_for_chapter, {chapter_identifier: chapter_text})
+
+def study_chapter_tasks(study_item):
+    """Yields one process_single_chapter task per chapter of a study item."""
     study_id = study_item.get('study_id', 'UNKNOWN_ID')
     pgn_string = study_item.get('pgn')
     study_title = study_item.get('title', 'Unknown Study') # For context in case of errors
+    for chapter_num, chapter_pgn in enumerate(split_pgn_into_chapters(pgn_string), start=1):
+        yield (study_id, study_title, chapter_num, chapter_pgn)
 
-    if not pgn_string:
-        return ([], {})
+def iter_single_study_data(study_item):
+    """
+    Yields the per-ply FEN record dicts of a study one chapter at a time, so
+    bulk consumers (ingestion, export) keep memory bounded by the deepest
+    chapter instead of the whole study. Chapter texts are not yielded; use
+    process_single_study_data when those are needed too.
+    """
+    for chapter_task in study_chapter_tasks(study_item):
+        chapter_fens, _ = process_single_chapter(chapter_task)
+        yield from chapter_fens
 
+def process_single_study_data(study_item):
+    """
+    Processes a single study item (dictionary) to extract FENs for each ply
+    and chapter text content. Chapters are processed independently, so a
+    malformed chapter no longer discards the rest of its study.
+    Returns a tuple: (list_of_fen_records, chapter_texts_map_for_this_study)
+    - list_of_fen_records: FENs without chapter text.
+    - chapter_texts_map_for_this_study: {chapter_identifier: chapter_text_content}
+    """
     processed_fens_for_study = []
     chapter_texts_map_for_this_study = {}
-    try:
-        pgn_file_handle = io.StringIO(pgn_string)
-        chapter_num = 0
-        while True:
-            chapter_num += 1
-            current_game_node = chess.pgn.read_game(pgn_file_handle)
-            if current_game_node is None:
-                break 
-
-            chapter_title_from_headers = current_game_node.headers.get("Event", f"Chapter {chapter_num}")
-            chapter_identifier = f"{study_title} - {chapter_title_from_headers}"
-
-            # Extract and format comments for the chapter, associating them with moves
-            formatted_comments_for_chapter = []
-            # TODO: Include other lines.
-            for i, node in enumerate(current_game_node.mainline()):
-                comment_to_add = None
-                if i == 0:  # Starting position of the chapter
-                    if node.comment and node.comment.strip():
-                        comment_to_add = f"Initial Chapter Comment: {node.comment.strip()}"
-                else:  # A position reached by a move
-                    # node.move is the move that led to this 'node'
-                    # node.parent.board() is the board state *before* node.move
-                    move_san = node.parent.board().san(node.move)
-                    move_prefix = ""
-                    if node.parent.board().turn == chess.WHITE:
-                        move_prefix = f"{node.parent.board().fullmove_number}. "
-                    else:
-                        move_prefix = f"{node.parent.board().fullmove_number}... "
-                    
-                    if node.comment and node.comment.strip():
-                        comment_to_add = f"{move_prefix}{move_san}: {node.comment.strip()}"
-                
-                if comment_to_add:
-                    formatted_comments_for_chapter.append(comment_to_add)
-            chapter_text_content = "\n".join(filter(None, formatted_comments_for_chapter))
-            chapter_texts_map_for_this_study[chapter_identifier] = chapter_text_content
-            
-            board = current_game_node.board()
-            
-            initial_full_fen = board.fen()
-            initial_dotted_fen = convert_fen_to_dotted_pieces(initial_full_fen)
-            processed_fens_for_study.append({
-                "dotted_fen": initial_dotted_fen,
-                "study_id": study_id,
-                "chapter": chapter_identifier,
-                "ply": 0,
-                "original_fen": initial_full_fen
-            })
-
-            for move in current_game_node.mainline_moves():
-                board.push(move)
-                full_fen = board.fen()
-                dotted_fen_pieces = convert_fen_to_dotted_pieces(full_fen)
-                processed_fens_for_study.append({
-                    "dotted_fen": dotted_fen_pieces,
-                    "study_id": study_id,
-                    "chapter": chapter_identifier,
-                    "ply": board.ply(),
-                    "original_fen": full_fen
-                })
-    except Exception as e:
-        error_context_chapter = chapter_identifier if 'chapter_identifier' in locals() else f"Chapter {chapter_num} (or earlier)"
-        print(f"Error processing PGN for study {study_id} ('{study_title}'), chapter context: '{error_context_chapter}': {e}. Skipping this study's remaining content.")
-        # Return whatever was processed so far for this study, along with its texts
-        return (processed_fens_for_study, chapter_texts_map_for_this_study) 
-    
+    for chapter_task in study_chapter_tasks(study_item):
+        chapter_fens, chapter_texts = process_single_chapter(chapter_task)
+        processed_fens_for_study.extend(chapter_fens)
+        chapter_texts_map_for_this_study.update(chapter_texts)
     return (processed_fens_for_study, chapter_texts_map_for_this_study)
 
-def main():
-    print(f"Loading studies from {INPUT_JSON_FILE}...")
+def load_studies(filepath=INPUT_STUDIES_FILE):
+    """
+    Loads the scraped studies: JSONL (one study per line, as the scraper now
+    streams them) or the legacy single-array JSON file. Returns None on error.
+    """
+    if filepath == INPUT_STUDIES_FILE and not os.path.exists(filepath) \
+            and os.path.exists(LEGACY_INPUT_JSON_FILE):
+        print(f"{filepath} not found, falling back to legacy {LEGACY_INPUT_JSON_FILE}.")
+        filepath = LEGACY_INPUT_JSON_FILE
     try:
-        with open(INPUT_JSON_FILE, 'r', encoding='utf-8') as f:
-            all_studies_data = json.load(f)
+        with open(filepath, 'r', encoding='utf-8') as f:
+            if filepath.endswith('.jsonl'):
+                return [json.loads(line) for line in f if line.strip()]
+            return json.load(f)
     except FileNotFoundError:
-        print(f"Error: Input file {INPUT_JSON_FILE} not found.")
-        return
+        print(f"Error: Input file {filepath} not found.")
+        return None
     except json.JSONDecodeError:
-        print(f"Error: Could not decode JSON from {INPUT_JSON_FILE}.")
+        print(f"Error: Could not decode JSON from {filepath}.")
+        return None
+
+def main():
+    print(f"Loading studies from {INPUT_STUDIES_FILE}...")
+    all_studies_data = load_studies()
+    if all_studies_data is None:
         return
 
     if not all_studies_data:
@@ -129,41 +296,93 @@ def main():
 
     print(f"Loaded {len(all_studies_data)} studies. Starting FEN processing with multiprocessing...")
 
+    # Splitting studies into chapters up front is a cheap text operation and
+    # gives the pool finer-grained tasks: one huge multi-chapter study no
+    # longer leaves the other workers idle at the tail.
+    chapter_tasks = [task for study_item in all_studies_data
+                     for task in study_chapter_tasks(study_item)]
+    print(f"Split into {len(chapter_tasks)} chapters.")
+
     num_processes = os.cpu_count()
     print(f"Using {num_processes} processes.")
 
-    all_processed_fens = []
-    all_chapter_texts_map = {}
-    with multiprocessing.Pool(processes=num_processes) as pool:
-        results_iterator = pool.imap_unordered(process_single_study_data, all_studies_data)
-        
-        for single_study_fens_list, single_study_chapter_texts_map in tqdm(results_iterator, total=len(all_studies_data), desc="Processing studies"):
-            if single_study_fens_list:
-                all_processed_fens.extend(single_study_fens_list)
-            if single_study_chapter_texts_map:
-                all_chapter_texts_map.update(single_study_chapter_texts_map)
+    # Chunked dispatch amortizes the pickling/IPC cost per task, and the
+    # semaphore-bounded generator keeps only a couple of chunks per worker in
+    # the task queue instead of pickling the whole chapter list up front.
+    chunksize = max(1, len(chapter_tasks) // (num_processes * 8))
+    in_flight = threading.Semaphore(num_processes * 2 * chunksize)
 
-    print(f"\nFinished processing. Total FENs extracted: {len(all_processed_fens)}")
+    def bounded_chapter_iter():
+        for chapter_task in chapter_tasks:
+            in_flight.acquire()
+            yield chapter_task
+
+    # Workers hand back columns (study/chapter once per chapter, not once per
+    # record), which are assembled straight into the Arrow table — no
+    # intermediate list of per-record dicts ever exists in the parent.
+    # Chapter texts are streamed out as JSONL (one {"chapter", "text"} object
+    # per line) while results arrive, so the text corpus never has to be held
+    # in memory alongside the FEN records.
+    all_dotted_fens = []
+    ply_chunks = []
+    study_code_per_chapter = []
+    chapter_code_per_chapter = []
+    fens_per_chapter = []
+    study_values = {}
+    chapter_values = {}
+    texts_file = None
+    num_chapter_texts = 0
+    try:
+        with multiprocessing.Pool(processes=num_processes) as pool:
+            results_iterator = pool.imap_unordered(process_chapter_columns, bounded_chapter_iter(), chunksize=chunksize)
 
-    if all_processed_fens:
+            for study_id, chapter_identifier, dotted_fens, plies, chapter_text in tqdm(
+                    results_iterator, total=len(chapter_tasks), desc="Processing chapters"):
+                in_flight.release()
+                if dotted_fens:
+                    all_dotted_fens.extend(dotted_fens)
+                    ply_chunks.append(plies)
+                    study_code_per_chapter.append(study_values.setdefault(study_id, len(study_values)))
+                    chapter_code_per_chapter.append(chapter_values.setdefault(chapter_identifier, len(chapter_values)))
+                    fens_per_chapter.append(len(dotted_fens))
+                if chapter_text is not None:
+                    if texts_file is None:
+                        texts_file = open(OUTPUT_CHAPTER_TEXTS_FILE, 'wb', buffering=4 * 1024 * 1024)
+                    texts_file.write(orjson.dumps({'chapter': chapter_identifier, 'text': chapter_text}))
+                    texts_file.write(b'\n')
+                    num_chapter_texts += 1
+    finally:
+        if texts_file is not None:
+            texts_file.close()
+
+    print(f"\nFinished processing. Total FENs extracted: {len(all_dotted_fens)}")
+
+    if all_dotted_fens:
         print(f"Saving processed FENs to {OUTPUT_PROCESSED_FILE}...")
         try:
-            with open(OUTPUT_PROCESSED_FILE, 'w', encoding='utf-8') as f:
-                json.dump(all_processed_fens, f, indent=2)
-            print(f"Successfully saved {len(all_processed_fens)} FENs to {OUTPUT_PROCESSED_FILE}")
-        except IOError as e:
+            # Columnar Feather instead of row-wise JSON: no per-record dict
+            # overhead on load, and study_id/chapter dictionary-encode well
+            # since the same strings repeat for every ply of a chapter.
+            repeats = np.array(fens_per_chapter, dtype=np.int64)
+            table = pa.table({
+                'dotted_fen': pa.array(all_dotted_fens),
+                'study_id': pa.DictionaryArray.from_arrays(
+                    np.repeat(np.array(study_code_per_chapter, dtype=np.int32), repeats),
+                    pa.array(list(study_values))),
+                'chapter': pa.DictionaryArray.from_arrays(
+                    np.repeat(np.array(chapter_code_per_chapter, dtype=np.int32), repeats),
+                    pa.array(list(chapter_values))),
+                'ply': pa.array(np.concatenate(ply_chunks)),
+            })
+            feather.write_feather(table, OUTPUT_PROCESSED_FILE, compression='zstd')
+            print(f"Successfully saved {len(all_dotted_fens)} FENs to {OUTPUT_PROCESSED_FILE}")
+        except (IOError, pa.ArrowInvalid) as e:
             print(f"Error saving processed FENs: {e}")
     else:
         print("No FENs were extracted. FEN output file will not be created.")
 
-    if all_chapter_texts_map:
-        print(f"Saving chapter text contents to {OUTPUT_CHAPTER_TEXTS_FILE}...")
-        try:
-            with open(OUTPUT_CHAPTER_TEXTS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(all_chapter_texts_map, f, indent=2)
-            print(f"Successfully saved {len(all_chapter_texts_map)} chapter text entries to {OUTPUT_CHAPTER_TEXTS_FILE}")
-        except IOError as e:
-            print(f"Error saving chapter texts: {e}")
+    if num_chapter_texts:
+        print(f"Saved {num_chapter_texts} chapter text entries to {OUTPUT_CHAPTER_TEXTS_FILE}")
     else:
         print("No chapter texts were extracted. Chapter text output file will not be created.")
 
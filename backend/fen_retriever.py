@@ -1,70 +1,491 @@
-import json
-import Levenshtein
+import os
+import re
 import time
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import chess
 import chess.pgn
 
-PROCESSED_FEN_FILE = "data/processed_study_fens.json"
-CHAPTER_TEXTS_FILE = "data/study_chapter_contents.json"
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.feather as feather
+try:
+    import faiss  # Optional: approximate-nearest-neighbour prefilter
+except ImportError:
+    faiss = None
+
+try:
+    from numba import njit, prange  # Optional: JIT-compiled Hamming kernels
+except ImportError:
+    njit = None
+
+PROCESSED_FEN_FILE = "data/processed_study_fens.feather"
+LEGACY_PROCESSED_FEN_JSON = "data/processed_study_fens.json"
+CHAPTER_TEXTS_FILE = "data/study_chapter_contents.jsonl"
+LEGACY_CHAPTER_TEXTS_JSON = "data/study_chapter_contents.json"
+ANN_INDEX_FILE = "data/fen_ann_index.bin"
+
+# Below this corpus size the exhaustive Hamming scan is cheap enough that an
+# ANN prefilter only adds overhead.
+ANN_MIN_CORPUS_SIZE = 5000
+# How many ANN candidates to rerank with exact Hamming distance.
+ANN_CANDIDATES = 500
+
+# One bit plane per piece type, in FEN symbol order
+_PIECE_PLANES = {symbol: plane for plane, symbol in enumerate('PNBRQKpnbrqk')}
+
+# Translation table expanding FEN empty-square digits into runs of dots,
+# so the conversion is a single C-level str.translate pass.
+_DIGIT_EXPAND_TABLE = str.maketrans({str(i): '.' * i for i in range(1, 9)})
+
+if njit is not None:
+    @njit(cache=True)
+    def _expand_board_field_nb(src, dst):  # pragma: no cover - exercised via wrapper
+        j = 0
+        for i in range(src.shape[0]):
+            c = src[i]
+            if 49 <= c <= 56:  # '1'..'8': write that many '.' bytes
+                for _ in range(c - 48):
+                    dst[j] = 46
+                    j += 1
+            else:
+                dst[j] = c
+                j += 1
+        return j
+
+# Positions recur heavily across queries on a warm server (every game shares
+# the starting position and common opening plies), so the expansion is
+# memoized on the board field alone — the other FEN fields don't affect the
+# dotted output and would only fragment the cache.
+@lru_cache(maxsize=131072)
+def _expand_board_field(piece_placement):
+    if njit is not None:
+        # ~1.5x faster than str.translate: the digit branch runs in native
+        # code and only one str is allocated, at the end. The buffer is
+        # sized for the worst case (every byte an '8') because the kernel
+        # does no bounds checking of its own.
+        src = np.frombuffer(piece_placement.encode('ascii'), np.uint8)
+        dst = np.empty(8 * len(src), np.uint8)
+        used = _expand_board_field_nb(src, dst)
+        expanded = dst[:used].tobytes().decode('ascii')
+    else:
+        expanded = piece_placement.translate(_DIGIT_EXPAND_TABLE)
+    # Every valid board expands to exactly 64 squares + 7 slashes
+    if len(expanded) != 71:
+        raise ValueError(f"FEN does not expand to a 64-square board: {piece_placement!r}")
+    return expanded
 
 def convert_fen_to_dotted_pieces(full_fen_string):
     """Converts the piece placement part of a FEN string to use dots for empty squares."""
     if not full_fen_string:
         return ""
-    piece_placement = full_fen_string.split(' ')[0]
-    dotted_placement = ''
-    for char in piece_placement:
-        if char.isdigit():
-            dotted_placement += '.' * int(char)
-        else:
-            dotted_placement += char
-    return dotted_placement
+    return _expand_board_field(full_fen_string.split(' ', 1)[0])
+
+_DOT_RUN_RE = re.compile(r'\.+')
+
+def dotted_to_fen_placement(dotted_fen):
+    """
+    Converts a dotted board string back to FEN piece placement by run-length
+    encoding the dots. Records no longer store the original FEN, so the
+    display path regenerates the placement from the dotted form.
+    """
+    return _DOT_RUN_RE.sub(lambda m: str(len(m.group())), dotted_fen)
+
+def _decode_dict_column(column):
+    """Returns (codes, values) for a dictionary-encoded Arrow column."""
+    combined = column.combine_chunks()
+    if pa.types.is_dictionary(combined.type):
+        return combined.indices.to_numpy(), combined.dictionary.to_pylist()
+    values, codes = np.unique(np.array(combined.to_pylist(), dtype=object), return_inverse=True)
+    return codes, list(values)
+
+class FenCorpus:
+    """
+    Columnar view of the processed FEN dataset: dotted FENs plus
+    dictionary-coded study/chapter columns. Unlike a list of per-record
+    dicts, only the handful of records actually matched or displayed are
+    ever materialized (via indexing).
+    """
+    def __init__(self, dotted_fens, study_codes, study_values, chapter_codes, chapter_values, plies):
+        self.dotted_fens = dotted_fens
+        self.study_codes = study_codes
+        self.study_values = study_values
+        self.chapter_codes = chapter_codes
+        self.chapter_values = chapter_values
+        self.plies = plies
+
+    @classmethod
+    def from_arrow(cls, table):
+        study_codes, study_values = _decode_dict_column(table.column('study_id'))
+        chapter_codes, chapter_values = _decode_dict_column(table.column('chapter'))
+        # Dotted boards are always 71 ASCII bytes, so they live in one
+        # contiguous fixed-width array: no per-row str object overhead, and
+        # np.unique / the bit-packing path operate on it directly.
+        dotted = np.asarray(table.column('dotted_fen').to_pylist(), dtype='S71')
+        return cls(dotted,
+                   study_codes, study_values,
+                   chapter_codes, chapter_values,
+                   table.column('ply').to_numpy())
+
+    @classmethod
+    def from_records(cls, records):
+        table = pa.table({
+            'dotted_fen': pa.array([r['dotted_fen'] for r in records]),
+            'study_id': pa.array([r['study_id'] for r in records]).dictionary_encode(),
+            'chapter': pa.array([r['chapter'] for r in records]).dictionary_encode(),
+            'ply': pa.array([r['ply'] for r in records], type=pa.int32()),
+        })
+        return cls.from_arrow(table)
+
+    def __len__(self):
+        return len(self.dotted_fens)
+
+    def __getitem__(self, idx):
+        return {
+            'dotted_fen': self.dotted_fens[idx].decode('ascii'),
+            'study_id': self.study_values[self.study_codes[idx]],
+            'chapter': self.chapter_values[self.chapter_codes[idx]],
+            'ply': int(self.plies[idx]),
+        }
 
 def load_processed_fens(filepath=PROCESSED_FEN_FILE):
-    """Loads the processed FEN data from the JSON file."""
+    """
+    Loads the processed FEN data as a FenCorpus.
+    Reads the columnar Feather file written by fen_processor (memory-mapped,
+    dictionary-encoded study/chapter columns); falls back to the legacy JSON
+    format when given a .json path or when the Feather file is missing.
+    """
+    if filepath.endswith('.feather'):
+        try:
+            table = feather.read_table(filepath, memory_map=True)
+            data = FenCorpus.from_arrow(table)
+            print(f"Successfully loaded {len(data)} FEN records from {filepath}")
+            return data
+        except FileNotFoundError:
+            if filepath == PROCESSED_FEN_FILE and os.path.exists(LEGACY_PROCESSED_FEN_JSON):
+                print(f"Feather file '{filepath}' not found. Falling back to {LEGACY_PROCESSED_FEN_JSON}.")
+                filepath = LEGACY_PROCESSED_FEN_JSON
+            else:
+                print(f"Error: Processed FEN file '{filepath}' not found.")
+                return None
+        except pa.ArrowInvalid as e:
+            print(f"Error: Could not read Feather file '{filepath}': {e}")
+            return None
+
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(filepath, 'rb') as f:
+            records = orjson.loads(f.read())
+        data = FenCorpus.from_records(records)
         print(f"Successfully loaded {len(data)} FEN records from {filepath}")
         return data
     except FileNotFoundError:
         print(f"Error: Processed FEN file '{filepath}' not found.")
         return None
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         print(f"Error: Could not decode JSON from '{filepath}'.")
         return None
 
+# Cache of the dotted-FEN corpus extracted from all_fens_data, so repeated
+# queries don't rebuild the list. The caches below each hold a reference to
+# their source object and compare with `is`: an id() key would go stale when
+# a dropped corpus's address is reused by a newly loaded one, silently
+# serving derived data for the wrong dataset.
+_dotted_corpus_cache = {'source': None, 'corpus': None}
+
+def get_dotted_corpus(all_fens_data):
+    """Returns the dotted FENs for all_fens_data as a fixed-width S71 array (cached per dataset)."""
+    if isinstance(all_fens_data, FenCorpus):
+        return all_fens_data.dotted_fens
+    if _dotted_corpus_cache['source'] is not all_fens_data:
+        _dotted_corpus_cache['source'] = all_fens_data
+        _dotted_corpus_cache['corpus'] = np.asarray(
+            [record['dotted_fen'] for record in all_fens_data], dtype='S71')
+    return _dotted_corpus_cache['corpus']
+
+# Every dotted board is exactly 64 squares, so Hamming distance (squares that
+# differ) replaces Levenshtein. Boards are packed into 12 uint64 occupancy
+# words (one per piece plane); OR-ing the per-plane XORs yields a 64-bit mask
+# of differing squares, and one popcount gives the distance — a dozen word
+# ops per board pair instead of a DP table or 64 byte compares.
+
+# SWAR popcount masks; LLVM lowers the sequence to POPCNTQ under Numba
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+_S1, _S2, _S4, _S56 = np.uint64(1), np.uint64(2), np.uint64(4), np.uint64(56)
+
+if njit is not None:
+    @njit(cache=True)
+    def _popcount64(x):
+        x = x - ((x >> _S1) & _M1)
+        x = (x & _M2) + ((x >> _S2) & _M2)
+        x = (x + (x >> _S4)) & _M4
+        return (x * _H01) >> _S56
+
+    @njit(parallel=True, cache=True)
+    def hamming_distances(query_words, corpus_words):
+        n = corpus_words.shape[0]
+        out = np.empty(n, np.uint16)
+        for i in prange(n):
+            mask = np.uint64(0)
+            for j in range(12):
+                mask |= corpus_words[i, j] ^ query_words[j]
+            out[i] = _popcount64(mask)
+        return out
+
+    @njit(parallel=True, cache=True)
+    def hamming_matrix(query_matrix, corpus_words):
+        p = query_matrix.shape[0]
+        n = corpus_words.shape[0]
+        out = np.empty((p, n), np.uint16)
+        for i in prange(n):
+            for q in range(p):
+                mask = np.uint64(0)
+                for j in range(12):
+                    mask |= corpus_words[i, j] ^ query_matrix[q, j]
+                out[q, i] = _popcount64(mask)
+        return out
+else:
+    def hamming_distances(query_words, corpus_words):
+        diff_mask = np.bitwise_or.reduce(corpus_words ^ query_words, axis=1)
+        return np.bitwise_count(diff_mask).astype(np.uint16)
+
+    def hamming_matrix(query_matrix, corpus_words):
+        return np.stack([hamming_distances(q, corpus_words) for q in query_matrix])
+
+_unique_corpus_cache = {'source': None, 'unique_fens': None, 'groups': None}
+
+def get_unique_corpus(all_fens_data):
+    """
+    Returns (unique_fens, groups) for all_fens_data, where groups[u] lists the
+    indices of every record sharing unique_fens[u] (cached per dataset).
+    Studies share many starting positions and transpositions, so scanning only
+    the unique dotted FENs cuts the distance workload severalfold.
+    """
+    if _unique_corpus_cache['source'] is not all_fens_data:
+        corpus = get_dotted_corpus(all_fens_data)
+        # Fixed-width bytes sort/compare as flat memcmp sweeps, so np.unique
+        # needs no object-array detour.
+        unique_arr, inverse = np.unique(corpus, return_inverse=True)
+        groups = [[] for _ in range(len(unique_arr))]
+        for record_idx, unique_idx in enumerate(inverse):
+            groups[unique_idx].append(record_idx)
+        _unique_corpus_cache['source'] = all_fens_data
+        _unique_corpus_cache['unique_fens'] = unique_arr
+        _unique_corpus_cache['groups'] = groups
+    return _unique_corpus_cache['unique_fens'], _unique_corpus_cache['groups']
+
+_bits_matrix_cache = {'source': None, 'matrix': None}
+
+def get_unique_bits_matrix(all_fens_data):
+    """Returns the (N_unique, 12) uint64 occupancy-word matrix for the unique corpus (cached per dataset)."""
+    if _bits_matrix_cache['source'] is not all_fens_data:
+        unique_fens, _ = get_unique_corpus(all_fens_data)
+        _bits_matrix_cache['source'] = all_fens_data
+        _bits_matrix_cache['matrix'] = pack_piece_words(unique_fens)
+    return _bits_matrix_cache['matrix']
+
+def _piece_plane_bits(dotted_fens):
+    """Returns the (N, 12*64) uint8 plane-occupancy matrix for dotted FENs."""
+    # View the boards as one (N, 64) byte matrix — bytes avoid per-char str
+    # overhead and let each piece plane be filled by a vectorized compare
+    # instead of a Python loop over every square. Fixed-width S71 arrays
+    # (the corpus storage format) are already one contiguous buffer.
+    if isinstance(dotted_fens, np.ndarray) and dotted_fens.dtype.kind == 'S':
+        joined = dotted_fens.tobytes().replace(b'/', b'')
+    else:
+        joined = ''.join(dotted_fens).encode('ascii').replace(b'/', b'')
+    squares = np.frombuffer(joined, dtype=np.uint8).reshape(len(dotted_fens), 64)
+    bits = np.zeros((len(dotted_fens), 12 * 64), dtype=np.uint8)
+    for symbol, plane in _PIECE_PLANES.items():
+        rows, cols = np.nonzero(squares == ord(symbol))
+        bits[rows, plane * 64 + cols] = 1
+    return bits
+
+def pack_piece_bits(dotted_fens):
+    """
+    Encodes dotted FENs as packed 768-bit piece-occupancy vectors
+    (12 piece planes x 64 squares), one uint8[96] row per FEN.
+    Hamming distance between these vectors approximates how many squares
+    differ between two positions.
+    """
+    return np.packbits(_piece_plane_bits(dotted_fens), axis=1)
+
+def convert_fens_to_dotted_batch(fen_list):
+    """
+    Expands many FENs (full or board-field-only) to dotted boards in one
+    vectorized pass, returning a fixed-width S71 array: digit bytes become
+    repeat counts for np.repeat, so the whole batch is two C-level scans
+    instead of a per-string conversion.
+    Empty inputs come back as empty entries (matching the scalar converter);
+    a board field that doesn't expand to a full 64-square board raises
+    ValueError naming the offending FEN.
+    """
+    if not len(fen_list):
+        return np.empty(0, dtype='S71')
+    boards = [fen.split(' ', 1)[0] for fen in fen_list]
+    padded = ''.join(board.ljust(71, '\x00') for board in boards).encode('ascii')
+    arr = np.frombuffer(padded, dtype=np.uint8).reshape(len(boards), 71)
+    digit_mask = (arr >= ord('1')) & (arr <= ord('8'))
+    counts = np.where(digit_mask, arr - ord('0'), 1)
+    counts[arr == 0] = 0  # drop the NUL padding
+    # Every valid board expands to exactly 64 squares + 7 slashes
+    row_lengths = counts.sum(axis=1)
+    bad_rows = np.flatnonzero((row_lengths != 71) & (row_lengths != 0))
+    if bad_rows.size:
+        raise ValueError(
+            f"FEN does not expand to a 64-square board: {fen_list[int(bad_rows[0])]!r}")
+    expanded = np.where(digit_mask, np.uint8(ord('.')), arr)
+    flat = np.repeat(expanded.ravel(), counts.ravel())
+    out = np.zeros((len(boards), 71), dtype=np.uint8)
+    out[row_lengths == 71] = flat.reshape(-1, 71)
+    return out.view('S71').ravel()
+
+def convert_fens_to_bitboards(fen_list):
+    """
+    Encodes FENs (full or board-field-only) as a bool (N, 12, 8, 8) tensor:
+    one plane per piece type in 'PNBRQKpnbrqk' order, ranks 8..1 from the
+    top as FEN lists them. The unpacked counterpart of pack_piece_bits for
+    ML-style consumers. Empty FENs yield all-false planes.
+    """
+    dotted = convert_fens_to_dotted_batch(fen_list)
+    planes = np.zeros((len(dotted), 12, 8, 8), dtype=bool)
+    valid = np.flatnonzero(dotted != b'')
+    if valid.size:
+        planes[valid] = _piece_plane_bits(dotted[valid]).reshape(-1, 12, 8, 8).astype(bool)
+    return planes
+
+def convert_fen_to_bitboards(fen):
+    """Single-FEN convenience wrapper around convert_fens_to_bitboards."""
+    return convert_fens_to_bitboards([fen])[0]
+
+def pack_piece_words(dotted_fens):
+    """Encodes dotted FENs as an (N, 12) uint64 matrix — one occupancy word per piece plane."""
+    return pack_piece_bits(dotted_fens).view(np.uint64)
+
+_ann_index_cache = {'source': None, 'index': None}
+
+def get_ann_index(all_fens_data, index_file=ANN_INDEX_FILE):
+    """
+    Returns a FAISS binary HNSW index over the piece-occupancy bit-vectors of
+    all_fens_data (cached per dataset), loading it from index_file when a
+    matching index was persisted by an earlier run.
+    Returns None if FAISS is unavailable.
+    """
+    if faiss is None:
+        return None
+    if _ann_index_cache['source'] is all_fens_data:
+        return _ann_index_cache['index']
+
+    unique_fens, _ = get_unique_corpus(all_fens_data)
+
+    index = None
+    if os.path.exists(index_file):
+        try:
+            candidate = faiss.read_index_binary(index_file)
+            if candidate.ntotal == len(unique_fens):
+                index = candidate
+                print(f"Loaded FEN ANN index with {index.ntotal} entries from {index_file}")
+        except RuntimeError as e:
+            print(f"Could not read ANN index from {index_file}: {e}. Rebuilding.")
+
+    if index is None:
+        print(f"Building FEN ANN index over {len(unique_fens)} unique positions...")
+        index = faiss.IndexBinaryHNSW(12 * 64, 32)
+        index.add(pack_piece_bits(unique_fens))
+        try:
+            faiss.write_index_binary(index, index_file)
+            print(f"Persisted FEN ANN index to {index_file}")
+        except (IOError, RuntimeError) as e:
+            print(f"Warning: could not persist ANN index to {index_file}: {e}")
+
+    # efSearch must comfortably exceed the number of requested candidates
+    # or HNSW recall collapses (the default is only 16).
+    index.hnsw.efSearch = ANN_CANDIDATES * 2
+
+    _ann_index_cache['source'] = all_fens_data
+    _ann_index_cache['index'] = index
+    return index
+
 def find_closest_fens_naive(query_dotted_fen, all_fens_data, top_n=5):
     """
-    Naively finds the top_n closest FENs from all_fens_data to the query_dotted_fen
-    using Levenshtein distance.
+    Finds the top_n closest FENs from all_fens_data to the query_dotted_fen
+    using Hamming distance over the 64 board squares (boards are fixed-length,
+    so no insertions/deletions apply). The whole unique corpus is scanned by a
+    single vectorized kernel, then the top_n records are picked out with
+    np.argpartition.
     Returns a list of tuples: (distance, fen_record).
     """
     if not all_fens_data:
         return []
 
-    distances = []
-    for record in all_fens_data:
-        dist = Levenshtein.distance(query_dotted_fen, record['dotted_fen'])
-        distances.append((dist, record))
-    
-    # Sort by distance
-    distances.sort(key=lambda x: x[0])
-    
-    return distances[:top_n]
+    unique_fens, groups = get_unique_corpus(all_fens_data)
+    bits_matrix = get_unique_bits_matrix(all_fens_data)
+    query_words = pack_piece_words([query_dotted_fen])[0]
+
+    # For large corpora, prefilter with the Hamming ANN index so the exact
+    # Hamming rerank only touches ANN_CANDIDATES positions instead of N.
+    candidate_ids = None
+    if len(unique_fens) >= ANN_MIN_CORPUS_SIZE:
+        index = get_ann_index(all_fens_data)
+        if index is not None:
+            _, ann_ids = index.search(pack_piece_bits([query_dotted_fen]),
+                                      min(ANN_CANDIDATES, len(unique_fens)))
+            candidate_ids = [int(i) for i in ann_ids[0] if i >= 0]
+
+    if candidate_ids is not None:
+        candidate_words = bits_matrix[np.asarray(candidate_ids, dtype=np.int64)]
+    else:
+        candidate_ids = range(len(unique_fens))
+        candidate_words = bits_matrix
+
+    dists = hamming_distances(query_words, candidate_words)
+
+    top_n_unique = min(top_n, len(dists))
+    top_idx = np.argpartition(dists, top_n_unique - 1)[:top_n_unique]
+    # Order the selected positions by distance (argpartition leaves them unsorted)
+    top_idx = top_idx[np.argsort(dists[top_idx])]
+
+    # Expand each unique position to the records that share its dotted FEN
+    results = []
+    for i in top_idx:
+        for record_idx in groups[candidate_ids[i]]:
+            results.append((int(dists[i]), all_fens_data[record_idx]))
+            if len(results) == top_n:
+                return results
+    return results
 
 def load_chapter_texts(filepath=CHAPTER_TEXTS_FILE):
-    """Loads the chapter text content from the JSON file."""
+    """
+    Loads the chapter text content as {chapter_identifier: text}.
+    Reads the JSONL written by fen_processor (one {"chapter", "text"} object
+    per line); falls back to the legacy single-object JSON format when given
+    a .json path or when the JSONL file is missing.
+    """
+    if filepath.endswith('.jsonl') and not os.path.exists(filepath) \
+            and filepath == CHAPTER_TEXTS_FILE and os.path.exists(LEGACY_CHAPTER_TEXTS_JSON):
+        print(f"JSONL file '{filepath}' not found. Falling back to {LEGACY_CHAPTER_TEXTS_JSON}.")
+        filepath = LEGACY_CHAPTER_TEXTS_JSON
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(filepath, 'rb') as f:
+            if filepath.endswith('.jsonl'):
+                data = {}
+                for line in f:
+                    if line.strip():
+                        entry = orjson.loads(line)
+                        data[entry['chapter']] = entry['text']
+            else:
+                data = orjson.loads(f.read())
         print(f"Successfully loaded {len(data)} chapter text entries from {filepath}")
         return data
     except FileNotFoundError:
         print(f"Error: Chapter texts file '{filepath}' not found.")
         return None
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         print(f"Error: Could not decode JSON from '{filepath}'.")
         return None
 
@@ -92,13 +513,36 @@ def get_fens_from_pgn_file(pgn_filepath):
         return None
     return fens
 
-def rank_studies_for_game(user_game_fens_list, all_fens_data, chapter_texts_map, top_n_ply_matches=1):
+# Per-worker corpus for the process-pool query path; loaded once per worker
+# from the mmap-backed Feather file by _init_query_worker.
+_worker_fens_data = None
+
+def _init_query_worker(fen_filepath):
+    global _worker_fens_data
+    _worker_fens_data = load_processed_fens(fen_filepath)
+
+def _score_ply_chunk(query_chunk, k):
+    """Scores a chunk of user plies against the worker's corpus; returns (top_idx, top_dists)."""
+    bits_matrix = get_unique_bits_matrix(_worker_fens_data)
+    dist_chunk = hamming_matrix(pack_piece_words(query_chunk), bits_matrix)
+    k = min(k, dist_chunk.shape[1])
+    top_idx = np.argpartition(dist_chunk, k - 1, axis=1)[:, :k]
+    return top_idx, np.take_along_axis(dist_chunk, top_idx, axis=1)
+
+# How many user plies each process-pool task scores at once
+_PLY_CHUNK_SIZE = 8
+
+def rank_studies_for_game(user_game_fens_list, all_fens_data, chapter_texts_map, top_n_ply_matches=1,
+                          num_workers=1, fen_filepath=PROCESSED_FEN_FILE):
     """
     Ranks studies/chapters based on their relevance to a user's game.
     user_game_fens_list: A list of FEN strings from the user's game.
     all_fens_data: The loaded processed FEN data from studies.
     top_n_ply_matches: How many top matches from the database to consider for each ply of the user's game.
     chapter_texts_map: A dictionary mapping chapter identifiers to their text content.
+    num_workers: If > 1, plies are scored by a process pool whose workers each
+        mmap the corpus from fen_filepath (shared OS page cache) instead of
+        receiving it pickled; useful on very large corpora.
     """
     if not all_fens_data or not user_game_fens_list:
         print("No FEN data or user game FENs provided for ranking studies.")
@@ -108,54 +552,82 @@ def rank_studies_for_game(user_game_fens_list, all_fens_data, chapter_texts_map,
         # Decide whether to proceed without text or return empty. For now, let's proceed.
         # return [] 
 
-    # Key: (study_id, chapter_title), Value: {'distances': [], 'ply_indices_matched': set()}
-    study_chapter_relevance = {}
-
-    print(f"Analyzing {len(user_game_fens_list)} plies from the user's game...")
-    for ply_idx, user_fen_full in enumerate(user_game_fens_list):
-        user_dotted_fen = convert_fen_to_dotted_pieces(user_fen_full)
-        if not user_dotted_fen:
-            # print(f"Skipping empty dotted FEN for ply {ply_idx}: {user_fen_full}")
-            continue
-
-        # Find the closest FENs in the database for the current ply of the user's game
-        closest_ply_matches = find_closest_fens_naive(user_dotted_fen, all_fens_data, top_n=top_n_ply_matches)
-
-        for dist, record in closest_ply_matches:
-            key = (record['study_id'], record['chapter'])
-            if key not in study_chapter_relevance:
-                study_chapter_relevance[key] = {'distances': [], 'ply_indices_matched': set()}
-            
-            study_chapter_relevance[key]['distances'].append(dist)
-            study_chapter_relevance[key]['ply_indices_matched'].add(ply_idx)
-    
-    if not study_chapter_relevance:
-        print("No relevant study chapters found after analyzing game plies.")
+    # Convert every ply of the user's game up front so the whole game can be
+    # scored against the corpus in a single vectorized pass.
+    query_vec = convert_fens_to_dotted_batch([f for f in user_game_fens_list if f])
+    if not len(query_vec):
+        print("No usable FENs in the user's game. Cannot rank studies.")
         return []
 
+    unique_fens, groups = get_unique_corpus(all_fens_data)
+    print(f"Analyzing {len(query_vec)} plies from the user's game...")
+
+    k = min(top_n_ply_matches, len(unique_fens))
+    if num_workers > 1:
+        # Shard plies across processes; each worker mmaps the corpus from
+        # disk once (shared page cache) rather than having it pickled over.
+        # Spawned (not forked) workers: numba's threading layer is not
+        # fork-safe, and forking after any parallel kernel has run in this
+        # process hangs the interpreter at teardown.
+        chunks = [query_vec[i:i + _PLY_CHUNK_SIZE] for i in range(0, len(query_vec), _PLY_CHUNK_SIZE)]
+        with ProcessPoolExecutor(max_workers=num_workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_query_worker,
+                                 initargs=(fen_filepath,)) as pool:
+            chunk_results = list(pool.map(_score_ply_chunk, chunks, [k] * len(chunks)))
+        top_idx = np.vstack([idx for idx, _ in chunk_results])
+        top_dists = np.vstack([dists for _, dists in chunk_results])
+    else:
+        # One (plies x unique corpus) distance matrix instead of a per-ply scan
+        dist_matrix = hamming_matrix(pack_piece_words(query_vec),
+                                     get_unique_bits_matrix(all_fens_data))
+        top_idx = np.argpartition(dist_matrix, k - 1, axis=1)[:, :k]
+        top_dists = np.take_along_axis(dist_matrix, top_idx, axis=1)
+
+    # Expand each matched unique position to every record sharing its dotted
+    # FEN, so duplicated positions credit all the chapters they occur in.
+    flat_idx = []
+    flat_dists = []
+    flat_plies = []
+    for ply_i in range(len(query_vec)):
+        for unique_idx, dist in zip(top_idx[ply_i], top_dists[ply_i]):
+            for record_idx in groups[unique_idx]:
+                flat_idx.append(record_idx)
+                flat_dists.append(int(dist))
+                flat_plies.append(ply_i)
+    flat_dists = np.array(flat_dists, dtype=np.int64)
+    ply_of_match = np.array(flat_plies, dtype=np.int64)
+
+    match_keys = np.array([all_fens_data[i]['study_id'] + '\x00' + all_fens_data[i]['chapter']
+                           for i in flat_idx])
+    uniq_keys, inverse = np.unique(match_keys, return_inverse=True)
+    dist_sums = np.bincount(inverse, weights=flat_dists)
+    match_counts = np.bincount(inverse)
+    # Distinct plies matched per chapter: dedupe (chapter, ply) pairs first
+    pair_codes = inverse.astype(np.int64) * len(query_vec) + ply_of_match
+    distinct_ply_counts = np.bincount(np.unique(pair_codes) // len(query_vec),
+                                      minlength=len(uniq_keys))
+
     # Calculate scores for ranking
     ranked_studies = []
-    for key, data in study_chapter_relevance.items():
-        if not data['distances']:
-            continue
-        
-        study_id, chapter_title = key
-        avg_distance = sum(data['distances']) / len(data['distances'])
+    for key_pos, key in enumerate(uniq_keys):
+        study_id, chapter_title = key.split('\x00', 1)
+        avg_distance = dist_sums[key_pos] / match_counts[key_pos]
         # How many unique plies of the user game this study/chapter had a top_n_ply_match for
-        num_distinct_ply_matches = len(data['ply_indices_matched']) 
-        
+        num_distinct_ply_matches = int(distinct_ply_counts[key_pos])
+
         ranked_studies.append({
             'study_id': study_id,
             'chapter': chapter_title,
             'chapter_text_content': chapter_texts_map.get(chapter_title, "Chapter text not found."),
-            'average_distance': avg_distance,
+            'average_distance': float(avg_distance),
             'distinct_ply_matches': num_distinct_ply_matches,
-            'total_close_references': len(data['distances']),
+            'total_close_references': int(match_counts[key_pos]),
             'lichess_url': f"https://lichess.org/study/{study_id}"
         })
 
     # Sort: prioritize studies/chapters that match more plies of the user's game,
-    # then by average Levenshtein distance (lower is better).
+    # then by average Hamming distance (lower is better).
     ranked_studies.sort(key=lambda x: (-x['distinct_ply_matches'], x['average_distance']))
     
     return ranked_studies
@@ -192,6 +664,12 @@ def main():
         default=1,
         help="For game analysis, how many top database FENs to consider for each ply of the user's game (default: 1)."
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes for game analysis; each worker memory-maps the corpus file (default: 1, in-process)."
+    )
 
     args = parser.parse_args()
 
@@ -211,7 +689,9 @@ def main():
             return
         
         start_time = time.time()
-        ranked_study_chapters = rank_studies_for_game(user_game_fens, all_fens_data, chapter_texts_map, top_n_ply_matches=args.top_n_ply_matches)
+        ranked_study_chapters = rank_studies_for_game(user_game_fens, all_fens_data, chapter_texts_map,
+                                                      top_n_ply_matches=args.top_n_ply_matches,
+                                                      num_workers=args.workers, fen_filepath=args.file)
         end_time = time.time()
 
         print(f"\nGame analysis completed in {end_time - start_time:.4f} seconds.")
@@ -235,8 +715,12 @@ def main():
             query_fen_to_process = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 1" # Default if no FEN and no game_pgn
             print(f"No query FEN or game PGN provided. Using default FEN: {query_fen_to_process}")
 
-        if ' ' in query_fen_to_process: 
-            query_dotted_fen = convert_fen_to_dotted_pieces(query_fen_to_process)
+        if ' ' in query_fen_to_process:
+            try:
+                query_dotted_fen = convert_fen_to_dotted_pieces(query_fen_to_process)
+            except ValueError as e:
+                print(f"Invalid query FEN: {e}")
+                return
             print(f"Original Query FEN: {query_fen_to_process}")
             print(f"Converted to Dotted Piece FEN for search: {query_dotted_fen}")
         else:
@@ -262,7 +746,7 @@ def main():
                 print(f"     Chapter: {record['chapter']}")
                 print(f"     Ply: {record['ply']}")
                 print(f"     Dotted FEN: {record['dotted_fen']}")
-                print(f"     Original FEN: {record['original_fen']}")
+                print(f"     FEN Placement: {dotted_to_fen_placement(record['dotted_fen'])}")
                 print("     -----")
         else:
             print("No matches found.")
@@ -1,45 +1,119 @@
-import requests
-from bs4 import BeautifulSoup
+import asyncio
 import json
-import time
+import httpx
+import lxml.html
+from lxml import etree
 
 BASE_URL = "https://lichess.org/study/all/popular?page={}"
 PGN_EXPORT_URL = "https://lichess.org/api/study/{}.pgn"
 NUM_PAGES_TO_SCRAPE = 13 # Approx 200 studies if ~16 per page, aiming for ~200
 TARGET_STUDY_COUNT = 200
-OUTPUT_FILE = "data/lichess_studies_2.json"
+OUTPUT_FILE = "data/lichess_studies_2.jsonl"
 
-def fetch_page(page_number):
+# How many PGN fetches may be in flight at once. Lichess speaks HTTP/2, so
+# the client multiplexes all of them over a couple of TCP+TLS connections —
+# no per-request connection setup and no HTTP/1.1 head-of-line blocking.
+# The semaphore (plus the per-fetch delay below) keeps us polite to Lichess.
+CONCURRENT_FETCH_LIMIT = 16
+MAX_CONNECTIONS = 2
+PGN_FETCH_DELAY_SECONDS = 0.5
+
+# Lichess serves cache validators, so repeat runs can revalidate instead of
+# re-downloading: we persist {url: {etag/last_modified, body}} and send
+# If-None-Match, getting a bodyless 304 back for anything unchanged.
+ETAG_CACHE_FILE = "data/.etag_cache.json"
+
+def load_etag_cache(filepath=ETAG_CACHE_FILE):
+    """Loads the persisted {url: {validators, body}} cache, or an empty one."""
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError:
+        print(f"Warning: could not decode ETag cache '{filepath}'. Starting fresh.")
+        return {}
+
+def save_etag_cache(etag_cache, filepath=ETAG_CACHE_FILE):
+    """Persists the ETag cache for the next run."""
+    try:
+        with open(filepath, 'w', encoding='utf-8') as f:
+            json.dump(etag_cache, f)
+    except IOError as e:
+        print(f"Warning: could not save ETag cache to {filepath}: {e}")
+
+async def _conditional_get(session, url, timeout_seconds, etag_cache):
+    """
+    GETs url, revalidating against etag_cache: sends If-None-Match (or
+    If-Modified-Since) when we hold a validator, and serves the cached body
+    on a 304. Returns the body text.
+    """
+    cached = etag_cache.get(url)
+    request_headers = {}
+    if cached:
+        if cached.get('etag'):
+            request_headers['If-None-Match'] = cached['etag']
+        elif cached.get('last_modified'):
+            request_headers['If-Modified-Since'] = cached['last_modified']
+
+    response = await session.get(url, headers=request_headers, timeout=timeout_seconds)
+    if response.status_code == 304 and cached:
+        print(f"Not modified (304), using cached body for {url}")
+        return cached['body']
+    response.raise_for_status()
+    body = response.text
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if etag or last_modified:
+        etag_cache[url] = {'etag': etag, 'last_modified': last_modified, 'body': body}
+    return body
+
+async def fetch_page(session, page_number, etag_cache):
     """Fetches the content of a Lichess studies page."""
     url = BASE_URL.format(page_number)
     print(f"Fetching {url}...")
     try:
-        response = requests.get(url, timeout=15)
-        response.raise_for_status()
-        return response.text
-    except requests.exceptions.RequestException as e:
+        return await _conditional_get(session, url, 15, etag_cache)
+    except httpx.HTTPError as e:
         print(f"Error fetching page {page_number} ({url}): {e}")
         return None
 
-def fetch_study_pgn(study_id):
-    """Fetches the PGN content for a given study_id."""
+async def fetch_study_pgn(session, study_id, semaphore, etag_cache):
+    """Fetches the PGN content for a given study_id, bounded by semaphore."""
     url = PGN_EXPORT_URL.format(study_id)
-    print(f"Fetching PGN for study {study_id} from {url}...")
-    try:
-        response = requests.get(url, timeout=20) # PGNs can be larger
-        response.raise_for_status()
-        return response.text
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching PGN for study {study_id} ({url}): {e}")
-        return None
+    async with semaphore:
+        print(f"Fetching PGN for study {study_id} from {url}...")
+        try:
+            pgn_text = await _conditional_get(session, url, 20, etag_cache) # PGNs can be larger
+        except httpx.HTTPError as e:
+            print(f"Error fetching PGN for study {study_id} ({url}): {e}")
+            pgn_text = None
+        # Hold the semaphore slot through the delay so the rate limit applies
+        # per slot, not just per connection.
+        await asyncio.sleep(PGN_FETCH_DELAY_SECONDS)
+    return pgn_text
+
+# Compiled XPaths for the study cards. The class tests mirror CSS semantics
+# (token membership, not exact match) so extra classes on a node don't break
+# extraction.
+def _has_class(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+_xp_study_divs = etree.XPath(f"//div[{_has_class('study')} and {_has_class('paginated')}]")
+_xp_overlay_link = etree.XPath(f".//a[{_has_class('overlay')}]")
+_xp_likes_icon = etree.XPath(f".//div[{_has_class('top')}]//span//i[@data-icon]")
+_xp_member_lis = etree.XPath(
+    f".//div[{_has_class('body')}]//ol[{_has_class('members')}]/li[{_has_class('text')}]")
 
 def parse_studies(html_content):
     """Parses study information from HTML content based on observed structure."""
     studies_on_page = []
-    soup = BeautifulSoup(html_content, 'html.parser')
+    # lxml.html directly: no per-node bs4 Tag wrapping, and the compiled
+    # XPaths above do the tree walks in C.
+    root = lxml.html.fromstring(html_content)
 
     # Each study is wrapped in a <div class="study paginated">
-    study_divs = soup.find_all('div', class_='study paginated')
+    study_divs = _xp_study_divs(root)
 
     if not study_divs:
         print("No study divs with class 'study paginated' found. HTML structure might have changed.")
@@ -50,60 +124,39 @@ def parse_studies(html_content):
         study_id, title, study_url, author_str, likes_str = None, "N/A", "N/A", "N/A", "N/A"
 
         # Link and Title from <a class="overlay"> tag
-        overlay_link_tag = study_div.find('a', class_='overlay')
-        if overlay_link_tag and overlay_link_tag.has_attr('href') and overlay_link_tag.has_attr('title'):
-            raw_link = overlay_link_tag['href']
-            title = overlay_link_tag['title'].strip()
-            if raw_link.startswith('/study/'):
-                parts = raw_link.split('/')
-                if len(parts) > 2:
-                    study_id = parts[2] # The part after /study/
-                    study_url = "https://lichess.org" + raw_link
-        
+        overlay_links = _xp_overlay_link(study_div)
+        if overlay_links:
+            raw_link = overlay_links[0].get('href')
+            raw_title = overlay_links[0].get('title')
+            if raw_link and raw_title:
+                title = raw_title.strip()
+                if raw_link.startswith('/study/'):
+                    parts = raw_link.split('/')
+                    if len(parts) > 2:
+                        study_id = parts[2] # The part after /study/
+                        study_url = "https://lichess.org" + raw_link
+
         if not study_id: # If overlay link didn't yield ID, skip this entry
             # print(f"Could not extract study_id from overlay_link for a study div. Title: {title}")
             continue
 
-        # Likes and Primary Author from <div class="top"> span
-        top_div = study_div.find('div', class_='top')
-        if top_div:
-            # Title can also be found here if needed: h2_name = top_div.find('h2', class_='study-name')
-            info_span = top_div.find('span') # The span containing likes and primary author
-            if info_span:
-                likes_icon = info_span.find('i', attrs={'data-icon': ''}) # Heart icon for likes
-                if likes_icon and likes_icon.next_sibling:
-                    likes_text_node = likes_icon.next_sibling
-                    if likes_text_node and isinstance(likes_text_node, str):
-                        likes_str = likes_text_node.strip().split('•')[0].strip()
-                
-                # Extract primary author from the same span
-                span_texts = [text.strip() for text in info_span.stripped_strings]
-                if len(span_texts) > 1:
-                    # Example: ['40179', '•', 'Toxenory', '•'] or ['40179', '•', 'Toxenory']
-                    # Find the author name, usually after the first '•'
-                    try:
-                        author_index = span_texts.index('•', 1) + 1 # find second '•' if present, or first for author
-                        if author_index < len(span_texts) and span_texts[author_index] != '•':
-                           # primary_author = span_texts[author_index]
-                           pass # We will get all authors from .members list anyway
-                    except ValueError: # If only one '•' (likes • author)
-                        if len(span_texts) > 2 and span_texts[1] == '•':
-                            # primary_author = span_texts[2]
-                            pass # We will get all authors from .members list anyway
-        
+        # Likes from the heart icon in the <div class="top"> span (the icon's
+        # tail text holds the count); the primary author shown next to it is
+        # ignored — the .members list has everyone.
+        likes_icons = _xp_likes_icon(study_div)
+        if likes_icons and likes_icons[0].tail:
+            likes_str = likes_icons[0].tail.strip().split('•')[0].strip()
+
         # All Authors from <div class="body"> <ol class="members">
-        body_div = study_div.find('div', class_='body')
         authors_found = []
-        if body_div:
-            members_ol = body_div.find('ol', class_='members')
-            if members_ol:
-                member_lis = members_ol.find_all('li', class_='text')
-                for li in member_lis:
-                    author_name = li.get_text(strip=True)
-                    if author_name:
-                        authors_found.append(author_name)
-        
-        author_str = ", ".join(sorted(list(set(authors_found)))) if authors_found else "N/A"
+        for li in _xp_member_lis(study_div):
+            author_name = li.text_content().strip()
+            if author_name:
+                authors_found.append(author_name)
+
+        # Single-pass dedup that keeps the order the page lists the members in
+        authors_found = list(dict.fromkeys(authors_found))
+        author_str = ", ".join(authors_found) if authors_found else "N/A"
 
         studies_on_page.append({
             'study_id': study_id,
@@ -116,51 +169,93 @@ def parse_studies(html_content):
 
     return studies_on_page
 
-def main():
-    all_studies_data = []
+def load_scraped_study_ids(filepath=OUTPUT_FILE):
+    """Returns the study_ids already in the JSONL output, so reruns resume."""
+    study_ids = set()
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    study_ids.add(json.loads(line)['study_id'])
+    except FileNotFoundError:
+        pass
+    except (json.JSONDecodeError, KeyError):
+        print(f"Warning: could not fully parse '{filepath}'; resuming with {len(study_ids)} known studies.")
+    return study_ids
+
+async def main_async():
     print(f"Fetching Lichess studies, aiming for ~{TARGET_STUDY_COUNT} studies from up to {NUM_PAGES_TO_SCRAPE} pages...")
 
-    for page_num in range(1, NUM_PAGES_TO_SCRAPE + 1):
-        if len(all_studies_data) >= TARGET_STUDY_COUNT:
-            print(f"Reached target of {TARGET_STUDY_COUNT} studies. Stopping page scraping.")
-            break
-
-        html = fetch_page(page_num)
-        if html:
-            studies_on_this_page = parse_studies(html)
-            if not studies_on_this_page and page_num == 1:
-                print("Warning: No studies found on the first page. Check HTML structure and selectors.")
-                break
-            elif not studies_on_this_page:
-                print(f"No more studies found on page {page_num}. Stopping.")
-                break
-            
-            print(f"Found {len(studies_on_this_page)} potential studies on page {page_num}.")
-            
-            for study_info in studies_on_this_page:
-                if len(all_studies_data) >= TARGET_STUDY_COUNT:
+    # Each study is appended (and flushed) to the JSONL output as soon as its
+    # PGN arrives: a crash loses at most the in-flight study, reruns skip
+    # what's already on disk, and peak memory stays at one page of studies.
+    scraped_ids = load_scraped_study_ids()
+    num_scraped = len(scraped_ids)
+    if num_scraped:
+        print(f"Resuming: {num_scraped} studies already in {OUTPUT_FILE}.")
+
+    semaphore = asyncio.Semaphore(CONCURRENT_FETCH_LIMIT)
+    etag_cache = load_etag_cache()
+    with open(OUTPUT_FILE, 'a', encoding='utf-8') as output_file:
+        async with httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                    max_keepalive_connections=MAX_CONNECTIONS),
+                timeout=20,
+                headers={'User-Agent': 'ChessGPT-scraper'}) as session:
+            for page_num in range(1, NUM_PAGES_TO_SCRAPE + 1):
+                if num_scraped >= TARGET_STUDY_COUNT:
+                    print(f"Reached target of {TARGET_STUDY_COUNT} studies. Stopping page scraping.")
                     break
-                pgn_content = fetch_study_pgn(study_info['study_id'])
-                if pgn_content:
-                    study_info['pgn'] = pgn_content
-                    all_studies_data.append(study_info)
-                    print(f"Successfully fetched PGN for study: {study_info['title'][:50]}... ({len(all_studies_data)}/{TARGET_STUDY_COUNT}) ")
+
+                html = await fetch_page(session, page_num, etag_cache)
+                if html:
+                    studies_on_this_page = parse_studies(html)
+                    if not studies_on_this_page and page_num == 1:
+                        print("Warning: No studies found on the first page. Check HTML structure and selectors.")
+                        break
+                    elif not studies_on_this_page:
+                        print(f"No more studies found on page {page_num}. Stopping.")
+                        break
+
+                    print(f"Found {len(studies_on_this_page)} potential studies on page {page_num}.")
+
+                    # Fetch this page's PGNs concurrently (the semaphore caps how
+                    # many are actually in flight), only as many as still needed,
+                    # skipping studies already written on a previous run.
+                    studies_needed = [study_info for study_info in studies_on_this_page
+                                      if study_info['study_id'] not in scraped_ids]
+                    studies_needed = studies_needed[:TARGET_STUDY_COUNT - num_scraped]
+                    pgn_contents = await asyncio.gather(
+                        *(fetch_study_pgn(session, study_info['study_id'], semaphore, etag_cache)
+                          for study_info in studies_needed))
+
+                    for study_info, pgn_content in zip(studies_needed, pgn_contents):
+                        if pgn_content:
+                            study_info['pgn'] = pgn_content
+                            output_file.write(json.dumps(study_info, ensure_ascii=False) + '\n')
+                            output_file.flush()
+                            scraped_ids.add(study_info['study_id'])
+                            num_scraped += 1
+                            print(f"Successfully fetched PGN for study: {study_info['title'][:50]}... ({num_scraped}/{TARGET_STUDY_COUNT}) ")
+                        else:
+                            print(f"Skipping study {study_info['study_id']} due to PGN fetch error.")
                 else:
-                    print(f"Skipping study {study_info['study_id']} due to PGN fetch error.")
-                time.sleep(0.5) # Be respectful to Lichess servers
-        else:
-            print(f"Failed to fetch page {page_num}, stopping.")
-            break
-        
-        if page_num < NUM_PAGES_TO_SCRAPE and len(all_studies_data) < TARGET_STUDY_COUNT:
-            time.sleep(1) # Wait a bit before fetching the next page of studies
-
-    print(f"\nTotal studies with PGNs scraped: {len(all_studies_data)}")
-
-    if all_studies_data:
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-            json.dump(all_studies_data, f, indent=4, ensure_ascii=False)
-        print(f"Successfully saved {len(all_studies_data)} studies to {OUTPUT_FILE}")
+                    print(f"Failed to fetch page {page_num}, stopping.")
+                    break
+
+                if page_num < NUM_PAGES_TO_SCRAPE and num_scraped < TARGET_STUDY_COUNT:
+                    await asyncio.sleep(1) # Wait a bit before fetching the next page of studies
+
+    print(f"\nTotal studies with PGNs in {OUTPUT_FILE}: {num_scraped}")
+    save_etag_cache(etag_cache)
+    return num_scraped
+
+def main():
+    num_scraped = asyncio.run(main_async())
+
+    if num_scraped:
+        print(f"Successfully saved {num_scraped} studies to {OUTPUT_FILE}")
     else:
         print("No studies were scraped and saved.")
 
@@ -1,10 +1,12 @@
+import asyncio
 import chess
 import chess.pgn
 import chess.engine
 import json
+import multiprocessing
 import os
 import io # Required for StringIO
-import html # For XML character escaping
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 import anthropic
 import xml.etree.ElementTree as ET
@@ -24,65 +26,120 @@ BLUNDER_THRESHOLD = 200    # 2.0 pawns
 # Lichess study base URL
 LICHESS_STUDY_URL = "https://lichess.org/study/"
 
+# Per-worker Stockfish process for the analysis pool. Engine searches are
+# CPU-bound, so one single-threaded engine per worker scales across cores;
+# the engine exits with its worker when the pool shuts down.
+_worker_engine = None
+
+def _init_analysis_worker(stockfish_path):
+    global _worker_engine
+    _worker_engine = chess.engine.SimpleEngine.popen_uci(stockfish_path)
+    try:
+        _worker_engine.configure({"Hash": 64, "Threads": 1})
+    except chess.engine.EngineError:
+        pass # Older builds without these options; defaults are fine
+
+def _analyse_fen(task):
+    """
+    Analyses one position in a pool worker.
+    task: (fen, limit, multipv or None)
+    Returns (eval_white_pov_cp, top_move_ucis, variation_scores) — primitives
+    only, so the result pickles cheaply back to the parent. variation_scores
+    holds each variation's white-POV cp score, aligned with top_move_ucis:
+    a variation's score is the eval of the position reached by playing its
+    first move, so the parent can reuse it as a post-move eval.
+    """
+    fen, limit, multipv = task
+    board = chess.Board(fen)
+    if multipv:
+        infos = _worker_engine.analyse(board, limit, multipv=multipv)
+    else:
+        infos = [_worker_engine.analyse(board, limit)]
+    eval_cp = infos[0].get("score").pov(chess.WHITE).score(mate_score=10000)
+    top_move_ucis = []
+    variation_scores = []
+    for info in infos:
+        if info.get("pv"):
+            top_move_ucis.append(info.get("pv")[0].uci())
+            variation_scores.append(info.get("score").pov(chess.WHITE).score(mate_score=10000))
+    return (eval_cp, top_move_ucis, variation_scores)
+
+# The study corpus and chapter texts never change within a process, so they
+# are loaded once on first use instead of per analysis. Keeping the same
+# corpus object alive also keeps fen_retriever's derived caches (packed
+# bitboards, unique-position index, ANN index) warm across requests. Failed
+# loads are not cached, so the data can still appear later (e.g. after
+# running fen_processor).
+_study_fens_cache = None
+_chapter_texts_cache = None
+
+def _get_study_fens():
+    global _study_fens_cache
+    if _study_fens_cache is None:
+        _study_fens_cache = fen_retriever.load_processed_fens()
+    return _study_fens_cache
+
+def _get_chapter_texts():
+    global _chapter_texts_cache
+    if _chapter_texts_cache is None:
+        _chapter_texts_cache = fen_retriever.load_chapter_texts()
+    return _chapter_texts_cache
+
 # Helper function to generate the LLM prompt XML
 def _generate_llm_prompt_xml(analyzed_moves, top_studies):
-    prompt_parts = []
-
-    prompt_parts.append("<prompt>")
-    prompt_parts.append("  <llm_role>You are a chess tutor. Analyze the provided game using Stockfish analysis and relevant Lichess studies.</llm_role>")
-    
-    prompt_parts.append("  <stockfish_analysis>")
+    # Build a real ElementTree instead of hand-concatenated strings:
+    # serialization escapes text automatically (no html.escape sprinkled
+    # around), and get_claude_opus_advice reads the same structure back, so
+    # producer and consumer can't drift apart.
+    root = ET.Element('prompt')
+    ET.SubElement(root, 'llm_role').text = "You are a chess tutor. Analyze the provided game using Stockfish analysis and relevant Lichess studies."
+
+    stockfish_analysis = ET.SubElement(root, 'stockfish_analysis')
+    bad_moves = []
     for move_data in analyzed_moves:
-        prompt_parts.append(f"    <move>")
-        prompt_parts.append(f"      <move_number>{move_data['move_number']}</move_number>")
-        prompt_parts.append(f"      <player_move_san>{html.escape(move_data['player_move_san'])}</player_move_san>")
-        prompt_parts.append(f"      <eval_before_white_pov>{move_data['eval_before_white_pov']}</eval_before_white_pov>")
-        prompt_parts.append(f"      <eval_after_white_pov>{move_data['eval_after_white_pov']}</eval_after_white_pov>")
-        prompt_parts.append(f"      <centipawn_loss>{move_data['cp_loss']}</centipawn_loss>")
-        prompt_parts.append(f"      <category>{move_data['category']}</category>")
-        if move_data['category'] in ['mistake', 'blunder'] and move_data['top_alternative_moves']:
-            prompt_parts.append(f"      <top_alternative_moves>")
+        is_bad_move = move_data['category'] in ('mistake', 'blunder')
+        if is_bad_move:
+            bad_moves.append(move_data)
+        move_el = ET.SubElement(stockfish_analysis, 'move')
+        ET.SubElement(move_el, 'move_number').text = str(move_data['move_number'])
+        ET.SubElement(move_el, 'player_move_san').text = move_data['player_move_san']
+        ET.SubElement(move_el, 'eval_before_white_pov').text = str(move_data['eval_before_white_pov'])
+        ET.SubElement(move_el, 'eval_after_white_pov').text = str(move_data['eval_after_white_pov'])
+        ET.SubElement(move_el, 'centipawn_loss').text = str(move_data['cp_loss'])
+        ET.SubElement(move_el, 'category').text = move_data['category']
+        if is_bad_move and move_data['top_alternative_moves']:
+            alternatives_el = ET.SubElement(move_el, 'top_alternative_moves')
             for alt_move in move_data['top_alternative_moves']:
-                prompt_parts.append(f"        <move>{html.escape(alt_move)}</move>")
-            prompt_parts.append(f"      </top_alternative_moves>")
-        prompt_parts.append(f"    </move>")
-    prompt_parts.append("  </stockfish_analysis>")
+                ET.SubElement(alternatives_el, 'move').text = alt_move
 
-    prompt_parts.append("  <lichess_studies>")
+    studies_el = ET.SubElement(root, 'lichess_studies')
     if top_studies:
         for study in top_studies:
-            prompt_parts.append(f"    <study>")
-            prompt_parts.append(f"      <study_id>{study['study_id']}</study_id>")
-            prompt_parts.append(f"      <chapter_title>{html.escape(study['chapter'])}</chapter_title>")
-            prompt_parts.append(f"      <url>{study['url']}</url>")
-            prompt_parts.append(f"      <relevance_stats>")
-            prompt_parts.append(f"        <average_distance>{study['average_distance']:.2f}</average_distance>")
-            prompt_parts.append(f"        <distinct_ply_matches>{study['distinct_ply_matches']}</distinct_ply_matches>")
-            prompt_parts.append(f"      </relevance_stats>")
-            prompt_parts.append(f"      <chapter_content>{html.escape(study.get('chapter_text_content', ''))}</chapter_content>")
-            prompt_parts.append(f"    </study>")
-    prompt_parts.append("  </lichess_studies>")
-
-    prompt_parts.append("  <response_format>")
-    prompt_parts.append("    <overview> Overall overview of what happened in the game, as well as the top Lichess study and its URL, and why it's relevant for them to read. </overview>")
-    for move_data in analyzed_moves:
-        if move_data['category'] in ['mistake', 'blunder']:
-            prompt_parts.append(f"    <move_recommendation>")
-            prompt_parts.append(f"      <move_number>{move_data['move_number']}</move_number>")
-            prompt_parts.append(f"      <ply>{move_data['ply_for_prompt']}</ply>")
-            prompt_parts.append(f"      <advice> <!-- LLM generated advice --> </advice>")
-            prompt_parts.append(f"      <hint> <!-- Hint 1 --> </hint>")
-            prompt_parts.append(f"      <hint> <!-- Hint 2 --> </hint>")
-            if move_data['top_alternative_moves']:
-                prompt_parts.append(f"      <top_moves>") 
-                for alt_move in move_data['top_alternative_moves']:
-                    prompt_parts.append(f"        <move>{html.escape(alt_move)}</move>")
-                prompt_parts.append(f"      </top_moves>")
-            prompt_parts.append(f"    </move_recommendation>")
-    prompt_parts.append("  </response_format>")
-    prompt_parts.append("</prompt>")
-    
-    return "\n".join(prompt_parts)
+            study_el = ET.SubElement(studies_el, 'study')
+            ET.SubElement(study_el, 'study_id').text = study['study_id']
+            ET.SubElement(study_el, 'chapter_title').text = study['chapter']
+            ET.SubElement(study_el, 'url').text = study['url']
+            stats_el = ET.SubElement(study_el, 'relevance_stats')
+            ET.SubElement(stats_el, 'average_distance').text = f"{study['average_distance']:.2f}"
+            ET.SubElement(stats_el, 'distinct_ply_matches').text = str(study['distinct_ply_matches'])
+            ET.SubElement(study_el, 'chapter_content').text = study.get('chapter_text_content', '')
+
+    response_format = ET.SubElement(root, 'response_format')
+    ET.SubElement(response_format, 'overview').text = " Overall overview of what happened in the game, as well as the top Lichess study and its URL, and why it's relevant for them to read. "
+    for move_data in bad_moves:
+        recommendation_el = ET.SubElement(response_format, 'move_recommendation')
+        ET.SubElement(recommendation_el, 'move_number').text = str(move_data['move_number'])
+        ET.SubElement(recommendation_el, 'ply').text = str(move_data['ply_for_prompt'])
+        ET.SubElement(recommendation_el, 'advice').append(ET.Comment(' LLM generated advice '))
+        ET.SubElement(recommendation_el, 'hint').append(ET.Comment(' Hint 1 '))
+        ET.SubElement(recommendation_el, 'hint').append(ET.Comment(' Hint 2 '))
+        if move_data['top_alternative_moves']:
+            top_moves_el = ET.SubElement(recommendation_el, 'top_moves')
+            for alt_move in move_data['top_alternative_moves']:
+                ET.SubElement(top_moves_el, 'move').text = alt_move
+
+    ET.indent(root, space='  ')
+    return ET.tostring(root, encoding='unicode')
 
 def analyze_game_and_generate_prompt(pgn_string: str, player_color_str: str):
     """
@@ -112,98 +169,119 @@ def analyze_game_and_generate_prompt(pgn_string: str, player_color_str: str):
 
     board = game.board()
     analyzed_moves = []
-    all_game_fens_for_study_retrieval = [board.fen()] # Start with initial position FEN
-
-    engine = None
-    try:
-        engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
-        # Set a default limit for analysis, e.g., 0.1 seconds per move or a certain depth
-        # Using a time limit for expediency as discussed.
-        # More complex scenarios might vary this or use depth.
-        analysis_limit = chess.engine.Limit(time=0.1) 
-
-        # Get initial evaluation of the starting position
-        # This helps establish a baseline if the first move is analyzed for player_color
-        # For simplicity, we'll calculate eval_before inside the loop for the position just before the player's move.
-
-        for i, node in enumerate(game.mainline()): # node is a GameNode, node.move is the move leading to this node's board state
-            move = node.move
-            # The board state *before* this move was `board`
-            # The board state *after* this move is `node.board()`
-            
-            current_player_turn = board.turn # True for White, False for Black
-
-            if current_player_turn == player_color:
-                move_number = board.fullmove_number if player_color == chess.WHITE else board.fullmove_number
-                ply_number = board.ply() # Ply number *before* the current move is made on `board`
-                # For prompt, if user wants 1-indexed game ply, it's board.ply() + 1 before board.push(move)
-                # Or, if it's after the move, it would be node.board().ply()
-
-                # Get evaluation *before* the player's move
-                info_before = engine.analyse(board, analysis_limit)
-                eval_before_cp = info_before.get("score").pov(chess.WHITE).score(mate_score=10000) # Mate score large to avoid issues with None
-
-                # Make the move on a temporary board to get eval_after, or use node.board()
-                board_after_move = board.copy()
-                board_after_move.push(move)
-                info_after = engine.analyse(board_after_move, analysis_limit)
-                eval_after_cp = info_after.get("score").pov(chess.WHITE).score(mate_score=10000)
-
-                # Centipawn loss calculation (from player's perspective)
-                # If player is White, loss is eval_before - eval_after
-                # If player is Black, loss is eval_after - eval_before (since eval_before and eval_after are from White's POV)
-                # Or, if we adjusted eval_after_cp and eval_before_cp for Black's perspective (by negating), then loss is always eval_before_cp - eval_after_cp
-                # Let's stick to White's POV for evals and adjust loss calculation
-                if player_color == chess.WHITE:
-                    cp_loss = eval_before_cp - eval_after_cp 
-                else: # Player is Black
-                    cp_loss = -(eval_before_cp - eval_after_cp) # Loss for black is gain for white
-
-                move_category = "fine"
-                if cp_loss >= BLUNDER_THRESHOLD:
-                    move_category = "blunder"
-                elif cp_loss >= MISTAKE_THRESHOLD:
-                    move_category = "mistake"
-                elif cp_loss >= INACCURACY_THRESHOLD:
-                    move_category = "inaccuracy"
-                
-                top_moves_for_prompt = []
-                if move_category in ["mistake", "blunder"]:
-                    # Get Stockfish's top N alternative moves from the position *before* the player's move
-                    # The 'info_before' object contains the best move (pv[0]) and possibly others if multipv is set.
-                    # For simplicity, let's assume info_before.get("pv")[0] is the best move. We might need to ask for multipv.
-                    # Let's re-analyze with multipv for this specific case to get a few top moves.
-                    multipv_info = engine.analyse(board, analysis_limit, multipv=3)
-                    for i in range(min(3, len(multipv_info))):
-                        best_move_variation = multipv_info[i].get("pv")
-                        if best_move_variation:
-                            top_moves_for_prompt.append(board.san(best_move_variation[0]))
-                
-                analyzed_moves.append({
-                    "move_number": move_number,
-                    "player_move_san": board.san(move),
-                    "board_fen_before": board.fen(),
-                    "eval_before_white_pov": info_before.get("score").white().score(mate_score=10000),
-                    "eval_after_white_pov": info_after.get("score").white().score(mate_score=10000),
-                    "cp_loss": cp_loss,
-                    "category": move_category,
-                    "stockfish_best_move_san": board.san(info_before.get("pv")[0]) if info_before.get("pv") else "N/A",
-                    "top_alternative_moves": top_moves_for_prompt, # For mistakes/blunders
-                    "ply_for_prompt": board.ply() + 1 # Example: 1-indexed game ply *before* move
-                })
-
-            # Crucial: advance the main board state for the next iteration
+    # Study retrieval only looks at piece placement (fen_retriever strips the
+    # FEN to its first field), so collect board_fen() here: it skips
+    # serializing the turn/castling/ep/clock fields every ply.
+    all_game_fens_for_study_retrieval = [board.board_fen()] # Start with initial position
+
+    # Pass 1 (no engine): walk the game once, collecting per-move metadata
+    # and the pre/post-move FENs that need analysing.
+    pending_moves = []
+    before_tasks = []
+    after_fens = []
+    analysis_limit = chess.engine.Limit(time=0.1)
+    # The post-move eval only anchors the centipawn-loss delta; a shallow
+    # fixed depth is stable and usually cheaper than another 0.1 s search.
+    post_move_limit = chess.engine.Limit(depth=10)
+
+    for node in game.mainline(): # node is a GameNode, node.move is the move leading to this node's board state
+        move = node.move
+        # The board state *before* this move is `board`; pushing the move
+        # below advances it to the post-move state — no per-ply
+        # board.copy() (which clones every bitboard plus the move stack).
+
+        if board.turn != player_color:
             board.push(move)
-            all_game_fens_for_study_retrieval.append(board.fen())
-
-    except Exception as e:
-        # Ensure engine is closed even if an error occurs elsewhere
-        if engine:
-            engine.quit()
-        raise e # Re-raise the exception after cleanup
-    finally:
-        if engine:
-            engine.quit()
+            all_game_fens_for_study_retrieval.append(board.board_fen())
+            continue
+
+        pending_moves.append({
+            "move_number": board.fullmove_number,
+            "ply_for_prompt": board.ply() + 1, # 1-indexed game ply *before* move
+            "player_move_san": board.san(move),
+            "player_move_uci": move.uci(),
+            "board_fen_before": board.fen(),
+        })
+        # Three PVs for the pre-move search so mistake/blunder alternatives
+        # come out of the same analysis instead of a second one.
+        before_tasks.append((pending_moves[-1]["board_fen_before"], analysis_limit, 3))
+
+        board.push(move)
+        all_game_fens_for_study_retrieval.append(board.board_fen())
+        after_fens.append(board.fen()) # Engine task needs the full FEN
+
+    # Pass 2: fan the positions out across the cores, one Stockfish per
+    # worker. Pre-move searches go first; when the player's move matches
+    # one of the three PV heads, that variation's score *is* the post-move
+    # eval, so the second search is only dispatched for the remaining moves
+    # (the player played something the engine didn't consider).
+    before_results = []
+    after_results_by_index = {}
+    if before_tasks:
+        max_workers = min(len(before_tasks), os.cpu_count() or 1)
+        # Spawned (not forked) workers: on a warm server, phase 2 of an
+        # earlier analysis has already run fen_retriever's numba parallel
+        # kernels in this process, and forking with those threads live hangs
+        # the interpreter at shutdown.
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_analysis_worker,
+                                 initargs=(STOCKFISH_PATH,)) as pool:
+            before_results = list(pool.map(_analyse_fen, before_tasks))
+
+            after_indices = []
+            after_tasks = []
+            for i, (move_meta, before_result) in enumerate(zip(pending_moves, before_results)):
+                if move_meta["player_move_uci"] not in before_result[1]:
+                    after_indices.append(i)
+                    after_tasks.append((after_fens[i], post_move_limit, None))
+            if after_tasks:
+                for i, result in zip(after_indices, pool.map(_analyse_fen, after_tasks)):
+                    after_results_by_index[i] = result
+
+    for move_index, (move_meta, (eval_before_cp, top_move_ucis, variation_scores)) in enumerate(
+            zip(pending_moves, before_results)):
+        after_result = after_results_by_index.get(move_index)
+        if after_result is not None:
+            eval_after_cp = after_result[0]
+        else:
+            # Player played a PV head: reuse that variation's score (already
+            # white-POV, so no side-to-move sign flip is needed).
+            eval_after_cp = variation_scores[top_move_ucis.index(move_meta["player_move_uci"])]
+        # SAN conversion needs the pre-move position back
+        board_before = chess.Board(move_meta["board_fen_before"])
+        stockfish_best_move_san = board_before.san(chess.Move.from_uci(top_move_ucis[0])) if top_move_ucis else "N/A"
+        top_alternative_sans = [board_before.san(chess.Move.from_uci(uci)) for uci in top_move_ucis[:3]]
+
+        # Centipawn loss calculation (from player's perspective)
+        # If player is White, loss is eval_before - eval_after
+        # If player is Black, loss is eval_after - eval_before (since eval_before and eval_after are from White's POV)
+        # Let's stick to White's POV for evals and adjust loss calculation
+        if player_color == chess.WHITE:
+            cp_loss = eval_before_cp - eval_after_cp
+        else: # Player is Black
+            cp_loss = -(eval_before_cp - eval_after_cp) # Loss for black is gain for white
+
+        move_category = "fine"
+        if cp_loss >= BLUNDER_THRESHOLD:
+            move_category = "blunder"
+        elif cp_loss >= MISTAKE_THRESHOLD:
+            move_category = "mistake"
+        elif cp_loss >= INACCURACY_THRESHOLD:
+            move_category = "inaccuracy"
+
+        analyzed_moves.append({
+            "move_number": move_meta["move_number"],
+            "player_move_san": move_meta["player_move_san"],
+            "board_fen_before": move_meta["board_fen_before"],
+            "eval_before_white_pov": eval_before_cp,
+            "eval_after_white_pov": eval_after_cp,
+            "cp_loss": cp_loss,
+            "category": move_category,
+            "stockfish_best_move_san": stockfish_best_move_san,
+            "top_alternative_moves": top_alternative_sans if move_category in ["mistake", "blunder"] else [], # For mistakes/blunders
+            "ply_for_prompt": move_meta["ply_for_prompt"]
+        })
 
     # For debugging or to see results so far:
     print("\n--- Analyzed Moves ---")
@@ -213,9 +291,9 @@ def analyze_game_and_generate_prompt(pgn_string: str, player_color_str: str):
 
     # --- Phase 2: Study Retrieval ---
     top_studies_for_prompt = []
-    # Load the database of processed FENs from studies
-    all_study_fens_data = fen_retriever.load_processed_fens()
-    chapter_texts_map = fen_retriever.load_chapter_texts() # Load chapter texts
+    # Load the database of processed FENs from studies (memoized per process)
+    all_study_fens_data = _get_study_fens()
+    chapter_texts_map = _get_chapter_texts() # Load chapter texts
 
     if chapter_texts_map is None: # Handle missing chapter text file
         print("Warning: Chapter texts map could not be loaded. Proceeding without chapter content.")
@@ -263,32 +341,67 @@ def analyze_game_and_generate_prompt(pgn_string: str, player_color_str: str):
     # The function will now return the prompt and defer API call to the main execution block or an API endpoint
     return llm_prompt
 
-def get_claude_opus_advice(xml_prompt_string: str, api_key: str):
-    """Sends the XML prompt to Claude 4 Opus and returns the advice."""
+async def analyze_game_and_generate_prompt_async(pgn_string: str, player_color_str: str):
+    """
+    Async wrapper for analyze_game_and_generate_prompt. The analysis blocks on
+    Stockfish for seconds, so async servers should run it on a worker thread
+    rather than holding the event loop.
+    """
+    return await asyncio.to_thread(analyze_game_and_generate_prompt, pgn_string, player_color_str)
+
+def _prepare_claude_request(xml_prompt):
+    """
+    Splits the prompt into (system_prompt, user_message_content) for the
+    Claude API. xml_prompt may be the serialized prompt string or the
+    ET.Element itself (in which case the re-parse is skipped entirely).
+    """
+    # llm_role is the first direct child of <prompt> and becomes the
+    # system prompt; the rest of the tree is the user message.
+    if isinstance(xml_prompt, ET.Element):
+        tree = xml_prompt
+    else:
+        tree = ET.fromstring(xml_prompt)
+    system_prompt_element = tree.find('llm_role')
+    system_prompt = system_prompt_element.text.strip() if system_prompt_element is not None and system_prompt_element.text else "You are a helpful chess tutor."
+
+    # Remove llm_role to create the user message part
+    if system_prompt_element is not None:
+        tree.remove(system_prompt_element)
+
+    # The user message is the remaining XML structure
+    user_message_xml_parts = []
+    for element in tree:
+        user_message_xml_parts.append(ET.tostring(element, encoding='unicode'))
+    return system_prompt, "\n".join(user_message_xml_parts)
+
+def _extract_claude_response_text(response):
+    # Assuming the response structure gives text content directly
+    # Based on Anthropic's typical API, the content is in response.content[0].text
+    if response.content and len(response.content) > 0 and hasattr(response.content[0], 'text'):
+        return response.content[0].text
+    return "Error: Unexpected response structure from Claude API."
+
+def _format_claude_error(e):
+    if isinstance(e, ET.ParseError):
+        return f"Error parsing XML prompt: {e}"
+    if isinstance(e, anthropic.APIConnectionError):
+        return f"Claude API connection error: {e.__cause__}"
+    if isinstance(e, anthropic.RateLimitError):
+        return f"Claude API rate limit exceeded: {e.response.text}"
+    if isinstance(e, anthropic.APIStatusError):
+        return f"Claude API status error (status {e.status_code}): {e.response}"
+    return f"An unexpected error occurred while contacting Claude API: {e}"
+
+def get_claude_opus_advice(xml_prompt, api_key: str):
+    """
+    Sends the XML prompt to Claude 4 Opus and returns the advice.
+    xml_prompt may be the serialized prompt string or the ET.Element itself.
+    """
     if not api_key:
         return "Error: ANTHROPIC_API_KEY not set. Cannot contact Claude API."
 
     try:
-        # Parse the XML to extract the system prompt (llm_role)
-        # and the user message (the rest of the prompt)
-        # This is a simplified approach; robust XML parsing might be needed for complex structures
-        # For now, we assume llm_role is the first direct child of <prompt>
-        # and the rest of the <prompt> content is the user message.
-        
-        tree = ET.fromstring(xml_prompt_string)
-        system_prompt_element = tree.find('llm_role')
-        system_prompt = system_prompt_element.text.strip() if system_prompt_element is not None and system_prompt_element.text else "You are a helpful chess tutor."
-        
-        # Remove llm_role to create the user message part
-        if system_prompt_element is not None:
-            tree.remove(system_prompt_element)
-        
-        # The user message is the remaining XML structure
-        user_message_xml_parts = []
-        for element in tree:
-            user_message_xml_parts.append(ET.tostring(element, encoding='unicode'))
-        user_message_content = "\n".join(user_message_xml_parts)
-
+        system_prompt, user_message_content = _prepare_claude_request(xml_prompt)
         client = anthropic.Anthropic(api_key=api_key)
         response = client.messages.create(
             model="claude-opus-4-20250514",
@@ -301,23 +414,36 @@ def get_claude_opus_advice(xml_prompt_string: str, api_key: str):
                 }
             ]
         )
-        # Assuming the response structure gives text content directly
-        # Based on Anthropic's typical API, the content is in response.content[0].text
-        if response.content and len(response.content) > 0 and hasattr(response.content[0], 'text'):
-            return response.content[0].text
-        else:
-            return "Error: Unexpected response structure from Claude API."
+        return _extract_claude_response_text(response)
+    except Exception as e:
+        return _format_claude_error(e)
 
-    except ET.ParseError as e:
-        return f"Error parsing XML prompt: {e}"
-    except anthropic.APIConnectionError as e:
-        return f"Claude API connection error: {e.__cause__}"
-    except anthropic.RateLimitError as e:
-        return f"Claude API rate limit exceeded: {e.response.text}"
-    except anthropic.APIStatusError as e:
-        return f"Claude API status error (status {e.status_code}): {e.response}"
+async def get_claude_opus_advice_async(xml_prompt, api_key: str):
+    """
+    Async variant of get_claude_opus_advice. The Claude call is pure network
+    wait, so awaiting AsyncAnthropic keeps an event loop free for other
+    requests while the model responds.
+    """
+    if not api_key:
+        return "Error: ANTHROPIC_API_KEY not set. Cannot contact Claude API."
+
+    try:
+        system_prompt, user_message_content = _prepare_claude_request(xml_prompt)
+        client = anthropic.AsyncAnthropic(api_key=api_key)
+        response = await client.messages.create(
+            model="claude-opus-4-20250514",
+            max_tokens=4000, # Adjust as needed
+            system=system_prompt,
+            messages=[
+                {
+                    "role": "user",
+                    "content": user_message_content
+                }
+            ]
+        )
+        return _extract_claude_response_text(response)
     except Exception as e:
-        return f"An unexpected error occurred while contacting Claude API: {e}"
+        return _format_claude_error(e)
 
 if __name__ == '__main__':
     # Load environment variables from .env file if it exists
@@ -4,7 +4,8 @@ import os
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from fen_processor import convert_fen_to_dotted_pieces, process_single_study_data
+from fen_processor import (convert_fen_to_dotted_pieces, process_single_study_data,
+                           iter_single_study_data)
 
 # --- Tests for convert_fen_to_dotted_pieces (from fen_processor.py) ---
 def test_fp_convert_fen_to_dotted_pieces_standard():
@@ -32,15 +33,17 @@ def test_process_single_study_data_simple_pgn():
         "title": "Simple Test Study",
         "pgn": "[Event \"Test Chapter\"]\n1. e4 e5 2. Nf3 Nc6 *"
     }
-    result = process_single_study_data(study_item)
+    result, chapter_texts = process_single_study_data(study_item)
     assert len(result) == 5 # Initial FEN + 4 plies
+    assert "Simple Test Study - Test Chapter" in chapter_texts
 
     # Check initial FEN (ply 0)
     assert result[0]["dotted_fen"] == "rnbqkbnr/pppppppp/......../......../......../......../PPPPPPPP/RNBQKBNR"
     assert result[0]["study_id"] == "test001"
     assert result[0]["chapter"] == "Simple Test Study - Test Chapter"
     assert result[0]["ply"] == 0
-    assert result[0]["original_fen"] == "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+    # original_fen is no longer stored; the dotted form carries the placement
+    assert "original_fen" not in result[0]
 
     # Check FEN after 1. e4 (ply 1)
     assert result[1]["dotted_fen"] == "rnbqkbnr/pppppppp/......../......../....P.../......../PPPP.PPP/RNBQKBNR"
@@ -70,7 +73,7 @@ def test_process_single_study_data_multiple_chapters():
 1. c4 *
 """)
     }
-    result = process_single_study_data(study_item)
+    result, chapter_texts = process_single_study_data(study_item)
     assert len(result) == 4 # 2 chapters, each with initial FEN + 1 ply
 
     # Chapter 1 checks
@@ -87,14 +90,30 @@ def test_process_single_study_data_multiple_chapters():
     assert result[3]["ply"] == 1
     assert result[3]["dotted_fen"] == "rnbqkbnr/pppppppp/......../......../..P...../......../PP.PPPPP/RNBQKBNR"
 
+def test_iter_single_study_data_matches_list_api():
+    study_item = {
+        "study_id": "test002",
+        "title": "Multi-Chapter Study",
+        "pgn": ("""
+[Event "Chapter 1"]
+1. d4 *
+
+[Event "Chapter 2"]
+1. c4 *
+""")
+    }
+    result, _ = process_single_study_data(study_item)
+    assert list(iter_single_study_data(study_item)) == result
+
 def test_process_single_study_data_no_pgn():
     study_item = {
         "study_id": "test003",
         "title": "No PGN Study",
         "pgn": None
     }
-    result = process_single_study_data(study_item)
+    result, chapter_texts = process_single_study_data(study_item)
     assert result == []
+    assert chapter_texts == {}
 
 def test_process_single_study_data_empty_pgn_string():
     study_item = {
@@ -102,8 +121,9 @@ def test_process_single_study_data_empty_pgn_string():
         "title": "Empty PGN Study",
         "pgn": ""
     }
-    result = process_single_study_data(study_item)
+    result, chapter_texts = process_single_study_data(study_item)
     assert result == []
+    assert chapter_texts == {}
 
 def test_process_single_study_data_malformed_pgn():
     # This PGN is intentionally broken to test error handling
@@ -115,7 +135,7 @@ def test_process_single_study_data_malformed_pgn():
     # Expecting it to process what it can before error, or return empty if error is immediate
     # The current implementation might print an error and return [] or partial results
     # For this test, we'll accept an empty list, assuming graceful failure
-    result = process_single_study_data(study_item)
+    result, chapter_texts = process_single_study_data(study_item)
     # Depending on how robust the PGN parser is, it might get some FENs or none.
     # The current fen_processor.py's process_single_study_data has a try-except
     # that returns [] on Exception. So we expect [].
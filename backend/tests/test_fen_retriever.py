@@ -3,7 +3,8 @@ import sys
 import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from fen_retriever import convert_fen_to_dotted_pieces
+from fen_retriever import (convert_fen_to_dotted_pieces, dotted_to_fen_placement,
+                           convert_fen_to_bitboards, convert_fens_to_dotted_batch)
 
 def test_convert_fen_to_dotted_pieces_standard():
     fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
@@ -19,3 +20,49 @@ def test_convert_fen_to_dotted_pieces_empty_fen():
     fen = "8/8/8/8/8/8/8/8 w - - 0 1"
     expected_dotted = "......../......../......../......../......../......../......../........"
     assert convert_fen_to_dotted_pieces(fen) == expected_dotted
+
+def test_convert_fen_to_dotted_pieces_malformed_board_raises():
+    # Over-long board fields must raise, not overflow the expansion buffer
+    # (this one expands to 127 bytes) or silently return a truncated board.
+    with pytest.raises(ValueError, match="88888888"):
+        convert_fen_to_dotted_pieces("88888888/8/8/8/8/8/8/8 w - - 0 1")
+    with pytest.raises(ValueError, match="8/8/8"):
+        convert_fen_to_dotted_pieces("8/8/8 w - - 0 1")
+
+def test_dotted_to_fen_placement_round_trip():
+    placement = "r1b1k1nr/p2p1p1p/n5N1/1p1P4/2p3P1/P1P1P3/2P1BP1P/R3K2R"
+    dotted = convert_fen_to_dotted_pieces(placement + " b KQkq - 0 22")
+    assert dotted_to_fen_placement(dotted) == placement
+
+def test_convert_fens_to_dotted_batch_matches_single():
+    fens = [
+        "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+        "r1b1k1nr/p2p1p1p/n5N1/1p1P4/2p3P1/P1P1P3/2P1BP1P/R3K2R b KQkq - 0 22",
+        "8/8/8/8/8/8/8/8 w - - 0 1",
+    ]
+    batch = convert_fens_to_dotted_batch(fens)
+    assert [d.decode('ascii') for d in batch] == [convert_fen_to_dotted_pieces(f) for f in fens]
+    assert len(convert_fens_to_dotted_batch([])) == 0
+
+def test_convert_fens_to_dotted_batch_empty_and_malformed():
+    # Empty inputs come back as empty entries, like the scalar converter.
+    batch = convert_fens_to_dotted_batch(["", "8/8/8/8/8/8/8/8 w - - 0 1"])
+    assert batch[0] == b''
+    assert batch[1].decode('ascii') == convert_fen_to_dotted_pieces("8/8/8/8/8/8/8/8 w - - 0 1")
+    # A board field that doesn't expand to 64 squares names the offender.
+    with pytest.raises(ValueError, match="8/8/8"):
+        convert_fens_to_dotted_batch(["8/8/8 w - - 0 1"])
+    # Empty FENs produce all-false bitboard planes rather than crashing.
+    assert not convert_fen_to_bitboards("").any()
+
+def test_convert_fen_to_bitboards_starting_position():
+    fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+    planes = convert_fen_to_bitboards(fen)
+    assert planes.shape == (12, 8, 8)
+    assert planes.dtype == bool
+    # Plane order is 'PNBRQKpnbrqk'; rank 8 is row 0, as FEN lists them.
+    assert planes[0][6].all()          # white pawns on rank 2
+    assert planes[5][7][4]             # white king on e1
+    assert planes[6][1].all()          # black pawns on rank 7
+    assert planes[11][0][4]            # black king on e8
+    assert planes.sum() == 32          # one bit per piece